@@ -1,5 +1,28 @@
+// By default this speaks the original protocol used by LinkSerial, where
+// every serial byte is clocked out and echoed back with what came in.
+// Set FRAMED to 1 for the framed protocol used by LinkBridge:
+//   'X' n_hi n_lo data...  clock out n bytes, reply with the n clocked in
+//   'Z' n_hi n_lo          clock out n zeros, reply with the n clocked in
+//   'D' us_hi us_lo        set the delay before each byte of an 'X' frame
+// 'Z' frames, like the original protocol, wait BULK_GAP us before each byte.
+#ifndef FRAMED
+#define FRAMED 0
+#endif
+
+#ifndef BAUD
+#if FRAMED
+#define BAUD 115200
+#else
+#define BAUD 9600
+#endif
+#endif
+
+#define BULK_GAP 20
+
+unsigned int gap = BULK_GAP;
+
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(BAUD);
   pinMode(PIN_SPI_SCK, OUTPUT);
   pinMode(PIN_SPI_MOSI, OUTPUT);
   pinMode(PIN_SPI_MISO, INPUT);
@@ -7,13 +30,43 @@ void setup() {
   SPCR = (1<<SPE) | (1<<MSTR) | (1<<CPOL) | (1<<CPHA) | (1<<SPR0);
 }
 
+byte exchange(byte ch, unsigned int us) {
+  delayMicroseconds(us);
+  SPDR = ch;
+  while (!(SPSR & (1<<SPIF)));
+  return SPDR;
+}
+
+#if FRAMED
+byte readByte() {
+  while (!Serial.available());
+  return Serial.read();
+}
+
+void loop() {
+  byte cmd = readByte();
+  unsigned int n = readByte() << 8;
+  n |= readByte();
+  switch (cmd) {
+  case 'X':
+    while (n--) {
+      Serial.write(exchange(readByte(), gap));
+    }
+    break;
+  case 'Z':
+    while (n--) {
+      Serial.write(exchange(0, BULK_GAP));
+    }
+    break;
+  case 'D':
+    gap = n;
+    break;
+  }
+}
+#else
 void loop() {
   while (Serial.available()) {
-    byte ch = Serial.read();
-    delayMicroseconds(20);
-    SPDR = ch;
-    while (!(SPSR & (1<<SPIF)));
-    ch = SPDR;
-    Serial.write(ch);
+    Serial.write(exchange(Serial.read(), gap));
   }
 }
+#endif
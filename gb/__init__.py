@@ -1,56 +1,181 @@
+import time
+
 class LinkParallel:
     SC = 1
     SI = 10
     SO = 2
+    # Time the Game Boy needs between command bytes sent with txb
+    GAP = 0.0004
+    PACED = True
+    # Set by LinkDL.set_trace
+    trace = None
 
-    def __init__(self, p):
+    def __init__(self, p, shadow=False):
         self.p = p
+        if shadow:
+            self.p.set_shadow()
         self.p.set_bit(self.SC, 1)
+        self.build_waveform()
 
     def tx(self, byte):
-        rx = 0
-        for i in range(7, -1, -1):
-            bit = (byte >> i) & 1
-            self.p.set_bit(self.SO, bit)
-            self.p.set_bit(self.SC, 0)
-            rx |= self.p.get_bit(self.SI) << i
-            self.p.set_bit(self.SC, 1)
-        return rx
+        if self.trace is None:
+            return self.p.play(self.waveform[byte], self.SI)
+        start = time.monotonic()
+        b = self.p.play(self.waveform[byte], self.SI)
+        self.trace.transfer('tx', time.monotonic() - start, 1)
+        return b
 
     def rx(self):
         return self.tx(0)
 
+    def txb(self, block):
+        start = time.monotonic() if self.trace is not None else 0
+        rx = []
+        for byte in block:
+            if rx:
+                deadline = time.monotonic() + self.GAP
+                while time.monotonic() < deadline:
+                    pass
+            rx.append(self.p.play(self.waveform[byte], self.SI))
+        if self.trace is not None:
+            self.trace.transfer('txb', time.monotonic() - start, len(rx))
+        return bytes(rx)
+
     def rxb(self, n=1):
-        bstring = b''
-        for i in range(size):
-            bstring += struct.pack("B", self.rx())
-        return bstring
+        start = time.monotonic() if self.trace is not None else 0
+        wave = self.waveform[0]
+        data = bytes([self.p.play(wave, self.SI) for i in range(n)])
+        if self.trace is not None:
+            self.trace.transfer('rxb', time.monotonic() - start, n)
+        return data
+
+    def build_waveform(self):
+        # Steps only carry the SO and SC bits; play merges them into the
+        # port's current registers, so other pins are left alone
+        def step(pin, b):
+            is_control, mask = self.p.pin_mask(pin)
+            return is_control, mask, self.p.apply_bit(pin, b, 0, 0)[is_control]
+        clock = (step(self.SC, 0), None, step(self.SC, 1))
+        self.waveform = []
+        for byte in range(256):
+            wave = []
+            last = None
+            for i in range(7, -1, -1):
+                bit = (byte >> i) & 1
+                if bit != last:
+                    wave.append(step(self.SO, bit))
+                    last = bit
+                wave.extend(clock)
+            self.waveform.append(tuple(wave))
 
 class LinkSerial:
     SPAN = 0x400
+    WINDOW = 2
     DEBUG = False
+    # txb sends bytes back to back, which is too fast for command headers
+    PACED = False
+    BAUD = 9600
+    # Set by LinkDL.set_trace
+    trace = None
 
     def __init__(self, p):
         self.p = p
 
+    @classmethod
+    def open(cls, port, timeout=1):
+        # Open a serial port at the rate the sketch uses for this protocol
+        import serial
+        return cls(serial.Serial(port, cls.BAUD, timeout=timeout))
+
     def tx(self, byte):
+        start = time.monotonic() if self.trace is not None else 0
         self.p.write(bytes([byte]))
         b = self.p.read(1)[0]
         if self.DEBUG:
             print("%02X-%02X" % (byte, b))
+        if self.trace is not None:
+            self.trace.transfer('tx', time.monotonic() - start, 1)
         return b
 
     def rx(self):
         return self.tx(0)
 
     def txb(self, block):
-        self.p.write(bytes(block))
-        return self.p.read(len(block))
+        block = bytes(block)
+        return self._transfer(len(block), lambda offset, size: block[offset:offset + size], 'txb')
 
     def rxb(self, n=1):
-        bstring = b''
-        while n > 0:
-            self.p.write(bytes([0] * min(self.SPAN, n)))
-            bstring += self.p.read(min(self.SPAN, n))
-            n -= self.SPAN
-        return bstring
+        return self._transfer(n, lambda offset, size: bytes(size), 'rxb')
+
+    def _transfer(self, n, span, kind, size=None, window=None):
+        if self.trace is None:
+            return self._stream(n, span, size, window)
+        start = time.monotonic()
+        data = self._stream(n, span, size, window)
+        self.trace.transfer(kind, time.monotonic() - start, len(data))
+        return data
+
+    def _stream(self, n, span, size=None, window=None):
+        # Keep up to window spans (WINDOW by default) written ahead of the
+        # one being read back so the cable doesn't sit idle between spans.
+        # span(offset, size) returns what to send for each one.
+        size = size or self.SPAN
+        window = window or self.WINDOW
+        buf = bytearray(n)
+        offsets = range(0, n, size)
+        for offset in offsets[:window]:
+            self.p.write(span(offset, min(size, n - offset)))
+        for i, offset in enumerate(offsets):
+            length = min(size, n - offset)
+            data = self.p.read(length)
+            buf[offset:offset + len(data)] = data
+            if len(data) < length:
+                return bytes(buf[:offset + len(data)])
+            if i + window < len(offsets):
+                ahead = offsets[i + window]
+                self.p.write(span(ahead, min(size, n - ahead)))
+        return bytes(buf)
+
+class LinkBridge(LinkSerial):
+    # Framed protocol spoken by arduino.ino when built with FRAMED 1:
+    # 'X' n_hi n_lo data... exchanges n bytes, 'Z' n_hi n_lo clocks out n
+    # zeros and 'D' us_hi us_lo sets the delay before each byte of an 'X'
+    # frame. Either transfer answers with the n bytes clocked in.
+    BAUD = 115200
+    EXCHANGE = b'X'
+    ZEROS = b'Z'
+    DELAY = b'D'
+    # The sketch waits GAP before each byte of an 'X' frame, which carries
+    # command headers; 'Z' bulk reads keep the sketch's own short delay
+    GAP = 0.0004
+    # An 'X' frame arrives faster than its bytes are clocked out, and the
+    # board only buffers 64 bytes with no flow control, so txb sends one
+    # frame of at most FRAME bytes at a time
+    FRAME = 0x20
+    PACED = True
+
+    def __init__(self, p):
+        super(LinkBridge, self).__init__(p)
+        self.set_delay(int(self.GAP * 1000000))
+
+    def tx(self, byte):
+        start = time.monotonic() if self.trace is not None else 0
+        self.p.write(self.EXCHANGE + bytes([0, 1, byte]))
+        b = self.p.read(1)[0]
+        if self.DEBUG:
+            print("%02X-%02X" % (byte, b))
+        if self.trace is not None:
+            self.trace.transfer('tx', time.monotonic() - start, 1)
+        return b
+
+    def txb(self, block):
+        block = bytes(block)
+        return self._transfer(len(block), lambda offset, size:
+                              self.EXCHANGE + bytes([size >> 8, size & 0xFF]) + block[offset:offset + size],
+                              'txb', self.FRAME, 1)
+
+    def rxb(self, n=1):
+        return self._transfer(n, lambda offset, size: self.ZEROS + bytes([size >> 8, size & 0xFF]), 'rxb')
+
+    def set_delay(self, us):
+        self.p.write(self.DELAY + bytes([us >> 8, us & 0xFF]))
@@ -0,0 +1,176 @@
+import argparse
+import json
+import sys
+import time
+
+from . import conn, mbc, sim
+
+
+class Case(object):
+    def __init__(self, name, carttype, run, romsize=2, ramsize=0):
+        self.name = name
+        self.carttype = carttype
+        self.run = run
+        self.romsize = romsize
+        self.ramsize = ramsize
+
+    def setup(self, config):
+        rom = sim.build_rom(self.carttype, self.romsize, self.ramsize, self.name)
+        cart = sim.load(rom, sim.random_bytes(0x20000, 1))
+        link = sim.LinkSim(cart, latency=config['latency'], bitrate=config['bitrate'],
+                           realtime=config['realtime'], error_rate=config['error_rate'])
+        dl = conn.Link2(link, conn.Pacer(config['delay']))
+        dl.VERIFY = config['verify']
+        if not dl.connect():
+            raise RuntimeError('Simulated link failed to connect')
+        m = mbc.detect(dl)
+        if hasattr(m, 'unlock_ram'):
+            m.unlock_ram()
+        link.reset_stats()
+        return cart, link, dl, m
+
+
+def _dump_rom(cart, dl, m):
+    return len(m.dump_rom())
+
+
+def _dump_rom_optimistic(cart, dl, m):
+    return len(m.dump_rom(optimistic=True))
+
+
+def _dump_ram(cart, dl, m):
+    return len(m.dump_ram())
+
+
+def _restore_ram(cart, dl, m):
+    ram = bytes((i * 7) & 0xFF for i in range(m.ramsize))
+    m.restore_ram(ram)
+    return len(ram)
+
+
+def _restore_ram_diff(cart, dl, m):
+    ram = bytearray(cart.ram[:m.ramsize])
+    for i in range(0, len(ram), 0x100):
+        ram[i] ^= 0xFF
+    m.restore_ram(bytes(ram), diff=True)
+    return len(ram)
+
+
+def _restore_eeprom(cart, dl, m):
+    ram = bytes((i * 7) & 0xFF for i in range(0x100))
+    m.restore_ram(ram)
+    return len(ram)
+
+
+def _read_ec(cart, dl, m):
+    return len(dl.read_ec(0x4000, 0x4000))
+
+
+CASES = [
+    Case('MBC.dump_rom', 0x19, _dump_rom),
+    Case('MBC1.dump_rom', 0x01, _dump_rom, romsize=5),
+    Case('MBC.dump_rom optimistic', 0x19, _dump_rom_optimistic),
+    Case('MBC.dump_ram', 0x1B, _dump_ram, ramsize=2),
+    Case('MBC.restore_ram', 0x1B, _restore_ram, ramsize=2),
+    Case('MBC.restore_ram diff', 0x1B, _restore_ram_diff, ramsize=2),
+    Case('MBC2.dump_ram', 0x06, _dump_ram),
+    Case('MBC2.restore_ram', 0x06, _restore_ram),
+    Case('MBC7.dump_ram', 0x22, _dump_ram),
+    Case('MBC7.restore_ram', 0x22, _restore_eeprom),
+    Case('TAMA5.dump_ram', 0xFD, _dump_ram),
+    Case('TAMA5.restore_ram', 0xFD, _restore_ram),
+    Case('LinkDL.read_ec', 0x19, _read_ec),
+]
+
+
+def run_case(case, config):
+    cart, link, dl, m = case.setup(config)
+    result = {'name': case.name}
+    start = time.monotonic()
+    try:
+        nbytes = case.run(cart, dl, m)
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        return result
+    wall = time.monotonic() - start
+    elapsed = wall if config['realtime'] else wall + link.link_time
+    result.update({
+        'bytes': nbytes,
+        'wall': wall,
+        'link_time': link.link_time,
+        'time': elapsed,
+        'bytes_per_sec': nbytes / elapsed if elapsed else None,
+        'round_trips': link.transfers,
+        'round_trips_per_kib': link.transfers * 1024.0 / nbytes if nbytes else None,
+        'exchanges': link.exchanges,
+        'verify': dl.verifier().stats,
+    })
+    return result
+
+
+def run(names=None, latency=0, bitrate=None, delay=conn.LinkDL.DELAY, realtime=False, label=None,
+        error_rate=0, verify=conn.LinkDL.VERIFY):
+    config = {
+        'latency': latency,
+        'bitrate': bitrate,
+        'delay': delay,
+        'realtime': realtime,
+        'error_rate': error_rate,
+        'verify': verify,
+    }
+    results = []
+    for case in CASES:
+        if names and case.name not in names:
+            continue
+        results.append(run_case(case, config))
+    return {'label': label, 'config': config, 'results': results}
+
+
+def compare(old, new):
+    before = {r['name']: r for r in old['results']}
+    lines = []
+    for r in new['results']:
+        o = before.get(r['name'])
+        if not o or 'error' in r or 'error' in o or not o['time']:
+            continue
+        lines.append('%-20s %10.3fs %10.3fs %7.2fx' % (r['name'], o['time'], r['time'], o['time'] / r['time']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark dump and restore paths against a simulated link')
+    parser.add_argument('cases', nargs='*', help='case names to run (default: all)')
+    parser.add_argument('--latency', type=float, default=0, help='seconds per link round trip')
+    parser.add_argument('--bitrate', type=float, default=None, help='link bits per second')
+    parser.add_argument('--delay', type=float, default=conn.LinkDL.DELAY, help='LinkDL.DELAY to use')
+    parser.add_argument('--error-rate', type=float, default=0, help='chance of a corrupted byte per byte read')
+    parser.add_argument('--verify', default=conn.LinkDL.VERIFY, choices=sorted(conn.VERIFIERS),
+                        help='read_ec verification strategy')
+    parser.add_argument('--realtime', action='store_true', help='actually sleep for simulated link time')
+    parser.add_argument('--label', help='label stored with the results, e.g. a version')
+    parser.add_argument('-o', '--output', help='write JSON results to this file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    parser.add_argument('--list', action='store_true', help='list available cases')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for case in CASES:
+            print(case.name)
+        return 0
+
+    results = run(args.cases, args.latency, args.bitrate, args.delay, args.realtime, args.label,
+                  args.error_rate, args.verify)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
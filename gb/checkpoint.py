@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+
+
+class CheckpointStore(object):
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, path):
+        self.path = path
+        self.cart = None
+        self.hashes = {}
+        try:
+            with open(os.path.join(path, self.MANIFEST)) as f:
+                manifest = json.load(f)
+            self.cart = manifest['cart']
+            self.hashes = manifest['hashes']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def identify(conn):
+        return {
+            'carttype': conn.carttype,
+            'romsize': conn.romsize,
+            'ramsize': conn.ramsize,
+            'checksum': conn.checksum,
+            'gamename': conn.gamename,
+        }
+
+    def check(self, conn):
+        # Start over if a different cart is inserted
+        cart = self.identify(conn)
+        if cart != self.cart:
+            self.clear()
+            self.cart = cart
+            self._save()
+            return False
+        return True
+
+    def clear(self, kind=None):
+        # Only remove files the store wrote; the directory may hold others
+        kinds = list(self.hashes) if kind is None else [kind]
+        for k in kinds:
+            for name in self.hashes.pop(k, {}):
+                try:
+                    os.unlink(self._file(k, int(name)))
+                except OSError:
+                    pass
+        if kind is None:
+            try:
+                os.unlink(os.path.join(self.path, self.MANIFEST))
+            except OSError:
+                pass
+        else:
+            self._save()
+
+    def _file(self, kind, index):
+        return os.path.join(self.path, '%s-%04X.bin' % (kind, index))
+
+    def _save(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        path = os.path.join(self.path, self.MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'cart': self.cart, 'hashes': self.hashes}, f, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def get(self, kind, index):
+        h = self.hashes.get(kind, {}).get(str(index))
+        if h is None:
+            return None
+        try:
+            with open(self._file(kind, index), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        if hashlib.sha1(data).hexdigest() != h:
+            return None
+        return data
+
+    def put(self, kind, index, data):
+        if data is None:
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(self._file(kind, index), 'wb') as f:
+            f.write(data)
+        self.hashes.setdefault(kind, {})[str(index)] = hashlib.sha1(data).hexdigest()
+        self._save()
@@ -1,12 +1,273 @@
 import hashlib
+import json
+import os
 import struct
 import time
 
+class Pacer(object):
+    CLASSES = ('handshake', 'command', 'bulk')
+    PATH = os.path.join('~', '.config', 'gblinkpy', 'pacing.json')
+    MIN_GAP = 0.00005
+    MAX_GAP = 0.01
+    SHRINK = 0.9
+    GROW = 2
+    STREAK = 32
+    # Below this, sleeping overshoots too much, so spin on the clock instead
+    SPIN = 0.002
+    trace = None
+
+    def __init__(self, gap=0.0004, port=None, path=None):
+        self.port = port
+        self.path = path or self.PATH
+        self.last = 0
+        self.gaps = {}
+        self.streaks = {}
+        self.stats = {}
+        self.reset(gap)
+
+    def reset(self, gap):
+        for cls in self.CLASSES:
+            self.gaps[cls] = gap
+            self.streaks[cls] = 0
+            self.stats[cls] = {'success': 0, 'failure': 0}
+
+    @classmethod
+    def load(cls, port, gap=0.0004, path=None):
+        pacer = cls(gap, port, path)
+        try:
+            with open(os.path.expanduser(pacer.path)) as f:
+                saved = json.load(f).get(str(port), {})
+        except (IOError, ValueError):
+            saved = {}
+        for c in cls.CLASSES:
+            if c in saved:
+                pacer.gaps[c] = saved[c]
+        return pacer
+
+    def save(self):
+        path = os.path.expanduser(self.path)
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            saved = {}
+        saved[str(self.port)] = self.gaps
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def wait(self, cls):
+        deadline = self.last + self.gaps[cls]
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if self.trace is not None:
+            self.trace.sleep(remaining)
+        if remaining > self.SPIN:
+            time.sleep(remaining - self.SPIN)
+        while time.monotonic() < deadline:
+            pass
+
+    def done(self):
+        self.last = time.monotonic()
+
+    def sleep(self, seconds):
+        # Fixed delays the protocol needs, e.g. after a busy mark
+        if self.trace is not None:
+            self.trace.sleep(seconds)
+        time.sleep(seconds)
+
+    def success(self, cls):
+        self.stats[cls]['success'] += 1
+        self.streaks[cls] += 1
+        if self.streaks[cls] >= self.STREAK:
+            self.streaks[cls] = 0
+            if self.gaps[cls] > self.MIN_GAP:
+                self.gaps[cls] = max(self.MIN_GAP, self.gaps[cls] * self.SHRINK)
+
+    def failure(self, cls):
+        self.stats[cls]['failure'] += 1
+        self.streaks[cls] = 0
+        self.gaps[cls] = min(self.MAX_GAP, max(self.MIN_GAP, self.gaps[cls] * self.GROW))
+
+
+class Verifier(object):
+    BLOCK = 0x100
+
+    def __init__(self):
+        self.stats = {'chunks': 0, 'reads': 0, 'bytes': 0, 'retries': 0, 'failures': 0}
+
+    def _read(self, conn, address, size):
+        self.stats['reads'] += 1
+        self.stats['bytes'] += size
+        return conn.read(address, size)
+
+    def _settle(self, conn, address, candidates, limit, retries=0):
+        # Re-read a range until it agrees with one of the earlier reads
+        while True:
+            data = self._read(conn, address, len(candidates[0]))
+            if data in candidates:
+                return data, retries
+            candidates.append(data)
+            retries += 1
+            self.stats['retries'] += 1
+            conn.pacer.failure('bulk')
+            if limit is not None and limit > 0 and retries > limit:
+                self.stats['failures'] += 1
+                return None, retries
+
+
+class VerifyPair(Verifier):
+    def read(self, conn, address, size, limit=None):
+        self.stats['chunks'] += 1
+        hashes = set()
+        retries = 0
+        while True:
+            data = self._read(conn, address, size)
+            h = hashlib.sha1(data).digest()
+            if h in hashes:
+                conn.pacer.success('bulk')
+                return data
+            if hashes:
+                self.stats['retries'] += 1
+                conn.pacer.failure('bulk')
+            hashes.add(h)
+            retries += 1
+            if limit is not None and limit > 0 and retries > limit:
+                self.stats['failures'] += 1
+                return None
+
+
+class VerifySubblock(Verifier):
+    def read(self, conn, address, size, limit=None):
+        self.stats['chunks'] += 1
+        a = self._read(conn, address, size)
+        b = self._read(conn, address, size)
+        if a == b:
+            conn.pacer.success('bulk')
+            return a
+        blocks = []
+        retries = 0
+        for x in range(0, size, self.BLOCK):
+            block_a = a[x:x + self.BLOCK]
+            block_b = b[x:x + self.BLOCK]
+            if block_a == block_b:
+                blocks.append(block_a)
+                continue
+            data, retries = self._settle(conn, address + x, [block_a, block_b], limit, retries)
+            if data is None:
+                return None
+            blocks.append(data)
+        return b''.join(blocks)
+
+
+class VerifyVote(Verifier):
+    def read(self, conn, address, size, limit=None):
+        self.stats['chunks'] += 1
+        reads = [self._read(conn, address, size) for i in range(3)]
+        if reads[0] == reads[1] == reads[2]:
+            conn.pacer.success('bulk')
+            return reads[0]
+        blocks = []
+        retries = 0
+        for x in range(0, size, self.BLOCK):
+            a, b, c = [r[x:x + self.BLOCK] for r in reads]
+            if a == b or a == c:
+                blocks.append(a)
+            elif b == c:
+                blocks.append(b)
+            else:
+                voted = bytearray(a)
+                for i in range(len(a)):
+                    if a[i] != b[i] and b[i] == c[i]:
+                        voted[i] = b[i]
+                    elif a[i] != b[i] and a[i] != c[i]:
+                        voted = None
+                        break
+                if voted is None:
+                    voted, retries = self._settle(conn, address + x, [a, b, c], limit, retries)
+                    if voted is None:
+                        return None
+                blocks.append(bytes(voted))
+        return b''.join(blocks)
+
+
+class VerifyLater(Verifier):
+    # For dumps: defer() reads a range once and keeps it under a key, such
+    # as the bank it was read from, and check() re-reads everything kept
+    # once the dump is done, calling select(key) first. Plain read_ec calls
+    # are checked straight away, like 'pair'.
+    def __init__(self):
+        super(VerifyLater, self).__init__()
+        self.pending = []
+
+    def read(self, conn, address, size, limit=None):
+        self.stats['chunks'] += 1
+        return self._confirm(conn, address, self._read(conn, address, size), limit)
+
+    def _confirm(self, conn, address, data, limit):
+        again = self._read(conn, address, len(data))
+        if again == data:
+            conn.pacer.success('bulk')
+            return data
+        self.stats['retries'] += 1
+        conn.pacer.failure('bulk')
+        fixed, retries = self._settle(conn, address, [data, again], limit, 1)
+        return fixed
+
+    def defer(self, conn, key, address, size):
+        chunks = []
+        for x in range(address, address + size, 0x800):
+            self.stats['chunks'] += 1
+            chunks.append(self._read(conn, x, min(0x800, address + size - x)))
+            self.remember(key, x, chunks[-1])
+        return b''.join(chunks)
+
+    def remember(self, key, address, data):
+        # Also for data read earlier, e.g. taken from a checkpoint
+        self.pending.append((key, address, data))
+
+    def check(self, conn, select=None, limit=None):
+        # Returns the (key, address, data) ranges that read back different.
+        # Ranges that never settled within limit are left in pending.
+        fixes = []
+        failed = []
+        for key, address, data in self.pending:
+            if select:
+                select(key)
+            fixed = self._confirm(conn, address, data, limit)
+            if fixed is None:
+                failed.append((key, address, data))
+            elif fixed != data:
+                fixes.append((key, address, fixed))
+        self.pending = failed
+        return fixes
+
+
+VERIFIERS = {
+    'pair': VerifyPair,
+    'subblock': VerifySubblock,
+    'vote': VerifyVote,
+    'later': VerifyLater,
+}
+
+
 class LinkDL:
     DELAY = 0.0004
+    VERIFY = 'pair'
+    # Send command headers and write streams with one txb, on links that
+    # space the bytes out themselves (PACED)
+    COALESCE = True
+    STREAM = 0x400
+    # Times a command is resent after its echo came back wrong
+    COMMAND_RETRIES = 3
+    trace = None
 
-    def __init__(self, link):
+    def __init__(self, link, pacer=None):
         self.link = link
+        self.pacer = pacer or Pacer(self.DELAY)
         self.connected = False
         self.carttype = None
         self.romsize = None
@@ -14,103 +275,259 @@ class LinkDL:
         self.checksum = None
         self.gamename = None
         self.rom = None
+        self.verifiers = {}
+        self.write_queue = []
+        self.echo_errors = 0
 
-    def _connect(self):
+    def set_trace(self, trace):
+        # Install a hook such as trace.Metrics on this connection, its pacer
+        # and the link, or remove it with None
+        self.trace = trace
+        self.pacer.trace = trace
+        if hasattr(self.link, 'trace'):
+            self.link.trace = trace
+
+    def _connect(self, probe=False):
+        # With probe set, a cart that doesn't answer this handshake isn't
+        # counted against the pacer; it may just speak the other protocol
         connected = False
         for i in range(0x800):
-            if self._write8(0x9A) == 0xB4:
+            if self._write8(0x9A, 'handshake') == 0xB4:
                 connected = True
                 break
 
         if not connected:
             return False
         connected = False
-        time.sleep(0.001)
+        self.pacer.sleep(0.001)
 
         for i in range(100):
-            if self._write8(0x9A) == 0x1D:
+            if self._write8(0x9A, 'handshake') == 0x1D:
                 connected = True
                 break
 
+        if not connected and not probe:
+            self.pacer.failure('handshake')
         return connected
 
-    def _read8(self):
-        time.sleep(self.DELAY)
-        return self.link.rx()
+    def _read8(self, pace='command'):
+        self.pacer.wait(pace)
+        b = self.link.rx()
+        self.pacer.done()
+        return b
 
-    def _write8(self, value):
-        time.sleep(self.DELAY)
-        return self.link.tx(value)
+    def _write8(self, value, pace='command'):
+        self.pacer.wait(pace)
+        b = self.link.tx(value)
+        self.pacer.done()
+        return b
 
     def _read16(self):
-        return (self._read8() << 8) | self._read8()
+        return (self._read8('handshake') << 8) | self._read8('handshake')
 
     def _read_string(self, size):
         bstring = []
         for i in range(size):
-            bstring.append(self._read8())
+            bstring.append(self._read8('handshake'))
         return ''.join([chr(c) for c in bstring])
 
     def _read_header(self):
-        self.carttype = self._read8()
-        self.romsize = self._read8()
-        self.ramsize = self._read8()
+        self.carttype = self._read8('handshake')
+        self.romsize = self._read8('handshake')
+        self.ramsize = self._read8('handshake')
         self.checksum = self._read16()
         self.gamename = self._read_string(16)
 
+    def _check_header(self):
+        if self._read8('handshake') != 0 or self._read8('handshake') != 0xFF:
+            self.pacer.failure('handshake')
+            return False
+        self.pacer.success('handshake')
+        return True
+
     def _read_bytestring(self, size):
-        time.sleep(self.DELAY)
-        return self.link.rxb(size)
+        self.pacer.wait('bulk')
+        bstring = self.link.rxb(size)
+        self.pacer.done()
+        return bstring
 
-    def connect(self):
-        if not self._connect():
+    def connect(self, probe=False):
+        start = time.monotonic() if self.trace is not None else 0
+        if not self._connect(probe):
             return False
         self._read_header()
-        if self._read8() != 0:
-            return False
-        if self._read8() != 0xFF:
+        if not self._check_header():
             return False
         self.connected = True
+        if self.trace is not None:
+            self.trace.command('handshake', time.monotonic() - start, 26)
         self.rom = self._read_bytestring(0x4000)
         return True
 
+    def _command(self, header):
+        # Send a whole command header in one transfer when the link can,
+        # leaving the per-byte pacing to it. Returns the offset of the first
+        # byte that didn't echo back, or None if they all did.
+        header = bytes(header)
+        if not self.COALESCE or not getattr(self.link, 'PACED', False):
+            echo = bytes(self._write8(b) for b in header)
+        else:
+            self.pacer.wait('command')
+            echo = self.link.txb(header)
+            self.pacer.done()
+        if echo == header:
+            return None
+        self.echo_errors += 1
+        self.pacer.failure('command')
+        for i, b in enumerate(echo):
+            if b != header[i]:
+                return i
+        return len(echo)
+
+    def _read(self, address, length):
+        header = (0x59, address >> 8, address & 0xFF, length >> 8, length & 0xFF)
+        for attempt in range(self.COMMAND_RETRIES + 1):
+            bad = self._command(header)
+            # The cart may have taken the command anyway, so always clock
+            # the data out to stay in step
+            data = self._read_bytestring(length)
+            if bad is None:
+                return data
+        raise IOError('Echo mismatch reading 0x%04X' % address)
+
     def read(self, address, length=1):
-        self._write8(0x59)
-        self._write8(address >> 8)
-        self._write8(address & 0xFF)
-        self._write8(length >> 8)
-        self._write8(length & 0xFF)
-        return self._read_bytestring(length)
-
-    def read_ec(self, address, size=1, limit=None):
+        if self.trace is None:
+            return self._read(address, length)
+        start = time.monotonic()
+        data = self._read(address, length)
+        self.trace.command('read', time.monotonic() - start, 5 + length)
+        return data
+
+    def verifier(self, strategy=None):
+        if strategy is None:
+            strategy = self.VERIFY
+        if not isinstance(strategy, str):
+            return strategy
+        if strategy not in self.verifiers:
+            self.verifiers[strategy] = VERIFIERS[strategy]()
+        return self.verifiers[strategy]
+
+    def read_ec(self, address, size=1, limit=None, strategy=None):
+        verifier = self.verifier(strategy)
+        retries = verifier.stats['retries']
         bstrings = []
         for x in range(address, address + size, 0x800):
-            hashes = set()
-            retries = 0
-            while True:
-                data = self.read(x, 0x800 if size >= 0x800 else size)
-                h = hashlib.sha1(data).digest()
-                if h in hashes:
-                    bstrings.append(data)
-                    break
-                hashes.add(h)
-                retries += 1
-                if limit is not None and limit > 0 and retries > limit:
-                    return None
+            data = verifier.read(self, x, 0x800 if size >= 0x800 else size, limit)
+            if data is None:
+                return None
+            bstrings.append(data)
             size -= 0x800
+        if self.trace is not None:
+            self.trace.retry('read_ec', verifier.stats['retries'] - retries)
         return b''.join(bstrings)
 
+    def _write(self, address, value):
+        header = (0x49, address >> 8, address & 0xFF, value)
+        for attempt in range(self.COMMAND_RETRIES + 1):
+            if self._command(header) is None:
+                return
+        raise IOError('Echo mismatch writing 0x%04X' % address)
+
     def write(self, address, value):
-        self._write8(0x49)
-        self._write8(address >> 8)
-        self._write8(address & 0xFF)
-        self._write8(value)
+        if self.trace is None:
+            self._write(address, value)
+            return
+        start = time.monotonic()
+        self._write(address, value)
+        self.trace.command('write', time.monotonic() - start, 4)
 
     def write_ec(self, address, value):
         while True:
             self.write(address, value)
             if ord(self.read(address)) == value:
+                self.pacer.success('command')
                 break
+            self.pacer.failure('command')
+            if self.trace is not None:
+                self.trace.retry('write_ec')
+
+    def write_batch(self, writes, verify=True, limit=None, replay=True):
+        # Send every write back to back, then check them with one bulk read
+        # per contiguous address range and only rewrite what didn't stick.
+        # Only meaningful for memory; don't verify mapper register writes.
+        # After an echo error the stream is resent from the first write that
+        # didn't echo back; clear replay when the writes can't be repeated
+        # (e.g. bit-banged pins) to get an IOError instead.
+        writes = list(writes)
+        self._write_stream(writes, replay)
+        pending = dict(writes)
+        if not verify:
+            return True
+        retries = 0
+        while pending:
+            failed = {}
+            for start, values in self._runs(pending):
+                data = self.read(start, len(values))
+                for i, value in enumerate(values):
+                    if data[i] != value:
+                        failed[start + i] = value
+            if not failed:
+                self.pacer.success('command')
+                break
+            self.pacer.failure('command')
+            if self.trace is not None:
+                self.trace.retry('write_batch', len(failed))
+            retries += 1
+            if limit is not None and limit > 0 and retries > limit:
+                return False
+            self._write_stream(failed.items(), replay)
+            pending = failed
+        return True
+
+    def _write_stream(self, writes, replay=True):
+        # Write commands can follow each other in the same transfer
+        if not self.COALESCE or not getattr(self.link, 'PACED', False):
+            for address, value in writes:
+                self.write(address, value)
+            return
+        stream = bytearray()
+        for address, value in writes:
+            stream += bytes((0x49, address >> 8, address & 0xFF, value))
+        offset = 0
+        retries = 0
+        while offset < len(stream):
+            chunk = stream[offset:offset + self.STREAM]
+            start = time.monotonic() if self.trace is not None else 0
+            bad = self._command(chunk)
+            if self.trace is not None:
+                self.trace.command('write_stream', time.monotonic() - start, len(chunk))
+            if bad is None:
+                offset += len(chunk)
+                retries = 0
+                continue
+            retries += 1
+            if not replay or retries > self.COMMAND_RETRIES:
+                raise IOError('Echo mismatch in write stream at write %d' % ((offset + bad) // 4))
+            # Everything before the write that went wrong arrived intact
+            offset += bad - bad % 4
+
+    @staticmethod
+    def _runs(writes):
+        runs = []
+        for address in sorted(writes):
+            if runs and runs[-1][0] + len(runs[-1][1]) == address:
+                runs[-1][1].append(writes[address])
+            else:
+                runs.append((address, [writes[address]]))
+        return runs
+
+    def queue_write(self, address, value):
+        self.write_queue.append((address, value))
+
+    def flush_writes(self, verify=True, limit=None):
+        writes = self.write_queue
+        self.write_queue = []
+        return self.write_batch(writes, verify, limit)
 
     def mark_busy(self, busy=True):
         pass
@@ -120,52 +537,62 @@ class LinkDL:
 
 
 class Link2(LinkDL):
-    def _connect(self):
+    def _connect(self, probe=False):
         connected = False
         for i in range(0x400):
-            if self._write8(0x99) == 0xB4:
+            if self._write8(0x99, 'handshake') == 0xB4:
                 connected = True
                 break
 
         if not connected:
             return False
         connected = False
-        time.sleep(0.001)
+        self.pacer.sleep(0.001)
 
         for i in range(100):
-            if self._write8(0x99) == 0x1D:
+            if self._write8(0x99, 'handshake') == 0x1D:
                 connected = True
                 break
 
+        if not connected and not probe:
+            self.pacer.failure('handshake')
         return connected
 
-    def connect(self):
-        if not self._connect():
+    def connect(self, probe=False):
+        start = time.monotonic() if self.trace is not None else 0
+        if not self._connect(probe):
             return False
         self._read_header()
-        if self._read8() != 0:
-            return False
-        if self._read8() != 0xFF:
+        if not self._check_header():
             return False
         self.connected = True
+        if self.trace is not None:
+            self.trace.command('handshake', time.monotonic() - start, 26)
         return True
 
     def mark_busy(self, busy=True):
+        start = time.monotonic() if self.trace is not None else 0
         if busy:
             self._write8(0x89)
         else:
             self._write8(0x8A)
-        time.sleep(0.02)
+        self.pacer.sleep(0.02)
+        if self.trace is not None:
+            self.trace.command('busy', time.monotonic() - start, 1)
 
 
-def detect_link(link):
-    dl = Link2(link)
-    if dl.connect():
+def detect_link(link, pacer=None, port=None):
+    # Without a pacer, one is loaded with the gaps last saved for port, if
+    # given; call dl.pacer.save() once the session is over to keep them
+    if pacer is None and port is not None:
+        pacer = Pacer.load(port)
+    dl = Link2(link, pacer)
+    if dl.connect(probe=True):
         return dl
     if dl._write8(0) == 0xB4:
-        if dl.connect():
+        if dl.connect(probe=True):
             return dl
-        dl = LinkDL(link)
+        dl = LinkDL(link, dl.pacer)
         if dl.connect():
             return dl
     return None
\ No newline at end of file
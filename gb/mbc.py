@@ -1,6 +1,29 @@
 import datetime
+import mmap
 import time
 
+from . import conn
+
+class MappedBanks(object):
+    # Presents a mapped ROM file as a list of banks, copying out one bank
+    # at a time, so checksums and repairs don't hold the whole ROM
+    def __init__(self, buf, size, nbanks):
+        self.buf = buf
+        self.size = size
+        self.nbanks = nbanks
+
+    def __len__(self):
+        return self.nbanks
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.nbanks:
+            raise IndexError(i)
+        return self.buf[i * self.size:(i + 1) * self.size]
+
+    def __setitem__(self, i, data):
+        self.buf[i * self.size:(i + 1) * self.size] = data
+
+
 class MBC(object):
     ROM_BANK_SIZE = 0x4000
     RAM_BANK_SIZE = 0x2000
@@ -28,85 +51,253 @@ class MBC(object):
         else:
             self.ramsize = 0
 
+        self.registers = {}
+        self.register_stats = {'written': 0, 'skipped': 0}
+
+    def set_register(self, address, value):
+        # Mapper register writes go through here so that writing a value
+        # the register already holds can be skipped
+        if self.registers.get(address) == value:
+            self.register_stats['skipped'] += 1
+            return
+        self.conn.write(address, value)
+        self.registers[address] = value
+        self.register_stats['written'] += 1
+
+    def invalidate(self):
+        # Call after the cart was reset or the link reconnected
+        self.registers = {}
+
     def unlock_ram(self, unlock=True):
-        self.conn.write(0x0000, 0xA if unlock else 0)
+        self.set_register(0x0000, 0xA if unlock else 0)
 
     def select_rom_bank(self, bank):
-        self.conn.write(0x2100, bank)
+        self.set_register(0x2100, bank)
 
     def select_ram_bank(self, bank):
-        self.conn.write(0x4000, bank)
+        self.set_register(0x4000, bank)
 
-    def dump_rom(self, cb=None, retries=None):
-        self.conn.mark_busy()
+    def rom_bank_address(self, bank):
+        return 0x4000 if bank else 0x0000
+
+    def read_rom_bank(self, bank, retries=None, later=None):
+        self.select_rom_bank(bank)
+        address = self.rom_bank_address(bank)
+        if later:
+            return later.defer(self.conn, bank, address, self.ROM_BANK_SIZE)
         if retries != 0:
-            rom = [self.conn.read_ec(0x0, self.ROM_BANK_SIZE, retries)]
-        else:
-            rom = [self.conn.read(0x0, self.ROM_BANK_SIZE)]
-        if cb:
-            cb(0, rom[0])
-        for i in range(1, self.nbanks):
-            self.select_rom_bank(i)
-            if retries != 0:
-                rom.append(self.conn.read_ec(0x4000, self.ROM_BANK_SIZE, retries))
-            else:
-                rom.append(self.conn.read(0x4000, self.ROM_BANK_SIZE))
+            return self.conn.read_ec(address, self.ROM_BANK_SIZE, retries)
+        return self.conn.read(address, self.ROM_BANK_SIZE)
+
+    def start_later(self):
+        # The connection's verifier if it is 'later', with nothing pending
+        verifier = self.conn.verifier()
+        if not isinstance(verifier, conn.VerifyLater):
+            return None
+        verifier.pending = []
+        return verifier
+
+    def check_later(self, later, banks, select, base, cb=None, retries=None):
+        # Patch banks with what the re-reads of a 'later' verifier found;
+        # base(i) is the address banks[i] was read from. Returns False if
+        # some ranges never read back the same twice.
+        for i, address, data in later.check(self.conn, select, retries):
+            offset = address - base(i)
+            banks[i] = banks[i][:offset] + data + banks[i][offset + len(data):]
+            if cb:
+                cb(i, banks[i])
+        return not later.pending
+
+    def dump_rom(self, cb=None, retries=None, optimistic=False, checkpoint=None):
+        # With optimistic set, every bank is read only once and the cart's
+        # header and global checksums decide whether anything is re-read;
+        # IOError is raised if they still don't add up after a full repair
+        # pass, so don't use it on carts with a bad header checksum.
+        # The 'later' verifier also reads each bank once, then re-reads them
+        # all after the dump. Until then, banks are checkpointed as
+        # unverified.
+        self.conn.mark_busy()
+        if checkpoint:
+            checkpoint.check(self.conn)
+        later = None if optimistic else self.start_later()
+        kind = 'rom_unverified' if optimistic or later else 'rom'
+        rom = []
+        for i in range(self.nbanks):
+            data = checkpoint.get('rom', i) if checkpoint else None
+            if data is None and checkpoint and kind != 'rom':
+                data = checkpoint.get(kind, i)
+                if data is not None and later:
+                    later.remember(i, self.rom_bank_address(i), data)
+            if data is None:
+                data = self.read_rom_bank(i, 0 if optimistic else retries, later)
+                if checkpoint:
+                    checkpoint.put(kind, i, data)
+            rom.append(data)
             if cb:
                 cb(i, rom[-1])
+        ok = True
+        if optimistic and not self.rom_checksums_ok(rom):
+            ok = self.repair_rom(rom, cb, retries)
+        if later:
+            ok = self.check_later(later, rom, self.select_rom_bank, self.rom_bank_address, cb, retries)
+        if checkpoint and kind != 'rom' and ok:
+            for i, data in enumerate(rom):
+                if checkpoint.get('rom', i) != data:
+                    checkpoint.put('rom', i, data)
+            checkpoint.clear(kind)
         self.conn.mark_idle()
+        if not ok:
+            raise IOError('ROM failed verification')
         return b''.join(rom)
 
-    def dump_ram(self):
+    def iter_rom(self, retries=None, later=None):
         self.conn.mark_busy()
+        try:
+            for i in range(self.nbanks):
+                yield i, self.read_rom_bank(i, retries, later)
+        finally:
+            self.conn.mark_idle()
+
+    def dump_rom_to_file(self, path, cb=None, retries=None, optimistic=False):
+        size = self.ROM_BANK_SIZE
+        later = None if optimistic else self.start_later()
+        with open(path, 'w+b') as f:
+            f.truncate(self.nbanks * size)
+            out = mmap.mmap(f.fileno(), self.nbanks * size)
+            try:
+                for i, data in self.iter_rom(0 if optimistic else retries, later):
+                    out[i * size:(i + 1) * size] = data
+                    if cb:
+                        cb(i, data)
+                rom = MappedBanks(out, size, self.nbanks)
+                ok = True
+                if optimistic and not self.rom_checksums_ok(rom):
+                    self.conn.mark_busy()
+                    ok = self.repair_rom(rom, cb, retries)
+                    self.conn.mark_idle()
+                if later:
+                    self.conn.mark_busy()
+                    ok = self.check_later(later, rom, self.select_rom_bank, self.rom_bank_address, cb, retries)
+                    self.conn.mark_idle()
+                out.flush()
+                if not ok:
+                    raise IOError('ROM in %s failed verification' % path)
+            finally:
+                out.close()
+        return self.nbanks * size
+
+    def rom_checksums_ok(self, rom):
+        header = rom[0][0x134:0x14E]
+        x = 0
+        for b in header[:-1]:
+            x = (x - b - 1) & 0xFF
+        if x != header[-1]:
+            return False
+        total = sum(sum(bank) for bank in rom) - rom[0][0x14E] - rom[0][0x14F]
+        return total & 0xFFFF == self.conn.checksum
+
+    def repair_rom(self, rom, cb=None, retries=None):
+        # The global checksum can't say where an error is, so walk the banks
+        # re-reading 2 KiB chunks and stop once the checksum adds up. Only
+        # chunks that disagree with the first pass go through read_ec.
+        for i in range(self.nbanks):
+            self.select_rom_bank(i)
+            address = self.rom_bank_address(i)
+            current = rom[i]
+            chunks = []
+            for x in range(0, self.ROM_BANK_SIZE, 0x800):
+                chunk = current[x:x + 0x800]
+                if self.conn.read(address + x, len(chunk)) != chunk:
+                    chunk = self.conn.read_ec(address + x, len(chunk), retries)
+                chunks.append(chunk)
+            bank = b''.join(chunks)
+            if bank != current:
+                rom[i] = bank
+                if cb:
+                    cb(i, bank)
+                if self.rom_checksums_ok(rom):
+                    return True
+        return self.rom_checksums_ok(rom)
+
+    def dump_ram(self, checkpoint=None):
+        # Saved chunks only resume an interrupted dump; SRAM changes while
+        # the cart is played, so they are dropped once the dump completes
+        self.conn.mark_busy()
+        if checkpoint:
+            checkpoint.check(self.conn)
+        later = self.start_later()
         ram = []
+        chunks = self.RAM_BANK_SIZE // 0x800
+        base = lambda i: 0xA000 + (i & (chunks - 1)) * 0x800
+        selected = None
         for i in range(self.ramsize // 0x800):
-            if not i & ((self.RAM_BANK_SIZE // 0x800) - 1):
-                self.select_ram_bank(i // (self.RAM_BANK_SIZE // 0x800))
-            ram.append(self.conn.read_ec(0xA000 + (i & ((self.RAM_BANK_SIZE // 0x800) - 1)) * 0x800, 0x800))
+            data = checkpoint.get('ram', i) if checkpoint else None
+            if data is not None and later:
+                later.remember(i, base(i), data)
+            if data is None:
+                if selected != i // chunks:
+                    selected = i // chunks
+                    self.select_ram_bank(selected)
+                if later:
+                    data = later.defer(self.conn, i, base(i), 0x800)
+                else:
+                    data = self.conn.read_ec(base(i), 0x800)
+                if checkpoint:
+                    checkpoint.put('ram', i, data)
+            ram.append(data)
+        if later:
+            self.check_later(later, ram, lambda i: self.select_ram_bank(i // chunks), base)
+        if checkpoint:
+            checkpoint.clear('ram')
         self.conn.mark_idle()
         return b''.join(ram)
 
-    def restore_ram(self, ram):
+    def restore_ram(self, ram, diff=False, checkpoint=None):
+        # With diff set, each bank is read back first and only the bytes
+        # that differ are written
+        if checkpoint:
+            checkpoint.clear('ram')
         self.conn.mark_busy()
-        for i in range(self.ramsize):
-            if not i & (self.RAM_BANK_SIZE - 1):
-                self.select_ram_bank(i // self.RAM_BANK_SIZE)
-            self.conn.write_ec(0xA000 + (i & (self.RAM_BANK_SIZE - 1)), ram[i])
+        size = min(self.ramsize, self.RAM_BANK_SIZE)
+        for bank in range(self.ramsize // size if size else 0):
+            self.select_ram_bank(bank)
+            self.restore_ram_bank(ram[bank * size:(bank + 1) * size], diff)
         self.conn.mark_idle()
 
+    def restore_ram_bank(self, data, diff=False):
+        if not diff:
+            for i in range(len(data)):
+                self.conn.queue_write(0xA000 + i, data[i])
+            self.conn.flush_writes()
+            return
+        # The differing bytes are scattered, so rather than verifying each
+        # run of them, send them unverified and check the whole bank with
+        # one read, rewriting whatever didn't stick
+        current = self.conn.read_ec(0xA000, len(data))
+        while True:
+            writes = [(0xA000 + i, b) for i, b in enumerate(data) if current[i] != b]
+            if not writes:
+                break
+            self.conn.write_batch(writes, verify=False)
+            current = self.conn.read_ec(0xA000, len(data))
+
 class MBC1(MBC):
     BANK_MODE_ROM = 0
     BANK_MODE_RAM = 1
     def set_bank_mode(self, mode):
-        self.conn.write(0x6000, mode)
+        self.set_register(0x6000, mode)
 
     def select_rom_bank(self, bank):
         self.set_bank_mode(self.BANK_MODE_RAM)
         super(MBC1, self).select_rom_bank(bank & 0x1F)
-        self.conn.write(0x4000, bank >> 5)
+        self.set_register(0x4000, bank >> 5)
 
     def select_ram_bank(self, bank):
         self.set_bank_mode(self.BANK_MODE_RAM)
         super(MBC1, self).select_ram_bank(bank)
 
-    def dump_rom(self, cb=None, retries=None):
-        self.conn.mark_busy()
-        if retries != 0:
-            rom = [self.conn.read_ec(0x0, 0x4000, retries)]
-        else:
-            rom = [self.conn.read(0x0, 0x4000)]
-        if cb:
-            cb(0, rom[0])
-        for i in range(1, self.nbanks):
-            self.select_rom_bank(i)
-            if retries != 0:
-                rom.append(self.conn.read_ec(0x4000 if i & 0x1F else 0x0000, 0x4000, retries))
-            else:
-                rom.append(self.conn.read(0x4000 if i & 0x1F else 0x0000, 0x4000))
-            if cb:
-                cb(i, rom[-1])
-        self.conn.mark_idle()
-        return b''.join(rom)
+    def rom_bank_address(self, bank):
+        return 0x4000 if bank & 0x1F else 0x0000
 
 class MBC2(MBC):
     def __init__(self, conn):
@@ -126,31 +317,83 @@ class MBC2(MBC):
         self.conn.mark_busy()
         for i in range(len(ram)):
             b = ram[i]
-            self.conn.write_ec(0xA000 + i * 2, 0xF0 | (b & 0xF))
-            self.conn.write_ec(0xA001 + i * 2, 0xF0 | (b >> 4))
+            self.conn.queue_write(0xA000 + i * 2, 0xF0 | (b & 0xF))
+            self.conn.queue_write(0xA001 + i * 2, 0xF0 | (b >> 4))
+        self.conn.flush_writes()
         self.conn.mark_idle()
 
 class MBC3(MBC):
+    RTC_POLL = 60
+
     def latch_rtc(self):
-        self.conn.write(0x6000, 0)
-        self.conn.write(0x6000, 1)
+        self.conn.write_batch([(0x6000, 0), (0x6000, 1)], verify=False)
 
     def read_rtc(self, reg):
         self.select_ram_bank(8 + reg)
         return self.conn.read(0xA000)
 
-    def get_time(self, latch=True):
+    def read_rtc_registers(self, latch=True):
+        # Start at whichever RTC register is already selected, so one bank
+        # switch is saved when snapshots are taken back to back
+        self.unlock_ram()
         if latch:
             self.latch_rtc()
-        hour = ord(self.read_rtc(2))
-        minute = ord(self.read_rtc(1))
-        second = ord(self.read_rtc(0))
-        return datetime.time(hour, minute, second)
+        regs = [0] * 5
+        current = self.registers.get(0x4000, 8) - 8
+        if not 0 <= current < 5:
+            current = 0
+        for i in range(5):
+            reg = (current + i) % 5
+            regs[reg] = ord(self.read_rtc(reg))
+        return regs
+
+    def rtc_snapshot(self):
+        before = time.time()
+        regs = self.read_rtc_registers()
+        host = (before + time.time()) / 2
+        days = (regs[4] & 1) << 8 | regs[3]
+        return {
+            'seconds': regs[0],
+            'minutes': regs[1],
+            'hours': regs[2],
+            'days': days,
+            'halted': bool(regs[4] & 0x40),
+            'carry': bool(regs[4] & 0x80),
+            'total': days * 86400 + regs[2] * 3600 + regs[1] * 60 + regs[0],
+            'host_time': host,
+        }
+
+    def poll_rtc(self, interval=None, count=None):
+        # Yields snapshots every interval seconds with the drift of the cart
+        # clock against the host clock since the first one. The link is only
+        # busy while a snapshot is being read.
+        if interval is None:
+            interval = self.RTC_POLL
+        first = None
+        n = 0
+        while count is None or n < count:
+            if n:
+                self.conn.pacer.sleep(interval)
+            self.conn.mark_busy()
+            snapshot = self.rtc_snapshot()
+            self.conn.mark_idle()
+            if first is None:
+                first = snapshot
+            host = snapshot['host_time'] - first['host_time']
+            drift = (snapshot['total'] - first['total']) - host
+            snapshot['drift'] = drift
+            snapshot['drift_ppm'] = drift / host * 1e6 if host else 0.0
+            n += 1
+            yield snapshot
+
+    def get_time(self, latch=True):
+        regs = self.read_rtc_registers(latch)
+        return datetime.time(regs[2], regs[1], regs[0])
 
 class MBC5(MBC):
     def select_rom_bank(self, bank):
         super(MBC5, self).select_rom_bank(bank & 0xFF)
-        self.conn.write(0x3000, bank >> 8)
+        self.set_register(0x3000, bank >> 8)
 
     def set_rumble(self, on=True):
         self.select_ram_bank(8 * on)
@@ -158,16 +401,22 @@ class MBC5(MBC):
 class MBC6(MBC):
     ROM_BANK_SIZE = 0x2000
     RAM_BANK_SIZE = 0x1000
+    # Flash is programmed 128 bytes at a time but erased by sector; the
+    # cart's MX29F008 has eight 128 KiB sectors
+    FLASH_BLOCK_SIZE = 0x80
+    FLASH_SECTOR_SIZE = 0x20000
+    FLASH_TIMEOUT = 2
+    FLASH_POLL = 0.01
     def select_rom_bank(self, bank, block=0):
-        self.conn.write(0x27FF + block * 0x1000, bank)
-        self.conn.write(0x2800 + block * 0x1000, 0)
+        self.set_register(0x27FF + block * 0x1000, bank)
+        self.set_register(0x2800 + block * 0x1000, 0)
 
     def select_ram_bank(self, bank, block=0):
-        self.conn.write(0x400 + block * 0x400, bank)
+        self.set_register(0x400 + block * 0x400, bank)
 
     def select_flash_bank(self, bank, block=0):
-        self.conn.write(0x27FF + block * 0x1000, bank)
-        self.conn.write(0x2800 + block * 0x1000, 8)
+        self.set_register(0x27FF + block * 0x1000, bank)
+        self.set_register(0x2800 + block * 0x1000, 8)
 
     def unlock_flash(self, unlock=True):
         self.conn.write(0x1000, 1)
@@ -180,7 +429,6 @@ class MBC6(MBC):
         self.select_flash_bank(1, 1)
         self.conn.write(0x6AAA, 0x55)
         self.select_flash_bank(bank, 1)
-        print(hex(bank), hex(address), hex(cmd))
         self.conn.write(address, cmd)
 
     def flash_jedec_id(self):
@@ -191,39 +439,124 @@ class MBC6(MBC):
         self.send_flash_command(0xF0)
         return mfg, dev
 
-    def flash_erase_block(self, bank, address):
-        self.conn.mark_busy()
+    def flash_wait(self, address, timeout=None):
+        # Poll the status bit, backing off up to FLASH_POLL between reads
+        deadline = time.monotonic() + (timeout or self.FLASH_TIMEOUT)
+        delay = 0
+        while not self.conn.read(address)[0] & 0x80:
+            if time.monotonic() > deadline:
+                return False
+            self.conn.pacer.sleep(delay)
+            delay = min(self.FLASH_POLL, delay * 2 or 0.0001)
+        return True
+
+    def flash_erase(self, bank, address):
         self.unlock_flash(True)
         self.conn.write(0x1000, 1)
         self.send_flash_command(0x80)
         self.send_flash_command(0x30, bank, 0x6000 + (address & ~0x7F))
-        while not self.conn.read(0x6000)[0] & 0x80:
-            pass
+        ok = self.flash_wait(0x6000)
         self.send_flash_command(0xF0, bank, 0x6000 + (address & ~0x7F))
         self.send_flash_command(0xF0, bank, 0x6000 + (address & ~0x7F))
         self.unlock_flash(False)
-        self.conn.mark_idle()
+        return ok
 
-    def flash_write_block(self, bank, address, block):
-        self.conn.mark_busy()
+    def flash_program(self, bank, address, block):
         self.unlock_flash(True)
         self.send_flash_command(0xA0)
         self.select_flash_bank(bank, 1)
         base = 0x6000 + (address & ~0x7F)
+        end = base + len(block) - 1
         self.conn.write(0x1000, 1)
-        for i, b in enumerate(block):
-            self.conn.write(base + i, b)
-        self.conn.write(base + len(block) - 1, 0x00)
-        while not self.conn.read(base + len(block) - 1)[0] & 0x80:
-            pass
-        self.conn.write(base + len(block) - 1, 0xF0)
-        self.conn.write(base + len(block) - 1, 0xF0)
-        self.conn.read(base, len(block))
+        writes = [(base + i, b) for i, b in enumerate(block)]
+        writes.append((end, 0x00))
+        self.conn.write_batch(writes, verify=False)
+        ok = self.flash_wait(end)
+        self.conn.write_batch([(end, 0xF0), (end, 0xF0)], verify=False)
+        data = self.conn.read(base, len(block))
         self.conn.write(0x1000, 0)
+        return ok and data == bytes(block)
+
+    def flash_erase_block(self, bank, address):
+        self.conn.mark_busy()
+        ok = self.flash_erase(bank, address)
+        self.conn.mark_idle()
+        return ok
+
+    def flash_write_block(self, bank, address, block):
+        self.conn.mark_busy()
+        ok = self.flash_program(bank, address, block)
+        self.conn.mark_idle()
+        return ok
+
+    def read_flash(self, offset, size):
+        data = []
+        for bank in range(offset // self.ROM_BANK_SIZE, (offset + size - 1) // self.ROM_BANK_SIZE + 1):
+            start = max(offset, bank * self.ROM_BANK_SIZE)
+            end = min(offset + size, (bank + 1) * self.ROM_BANK_SIZE)
+            self.unlock_flash(True)
+            self.send_flash_command(0xF0)
+            self.select_flash_bank(bank, 1)
+            data.append(self.conn.read_ec(0x6000 + start % self.ROM_BANK_SIZE, end - start))
+        return b''.join(data)
+
+    def program_flash(self, image, cb=None):
+        # Compare each sector with what's already in flash. Only a sector
+        # where some bit has to go from 0 back to 1 is erased, after which
+        # every block of it that isn't blank is programmed again, including
+        # any part of the sector past the end of image; otherwise only the
+        # blocks that differ are programmed. Returns statistics about the
+        # run.
+        size = self.FLASH_BLOCK_SIZE
+        stats = {'blocks': 0, 'skipped': 0, 'erased': 0, 'programmed': 0, 'failed': [],
+                 'bytes': 0, 'read_time': 0, 'erase_time': 0, 'program_time': 0}
+        start = time.monotonic()
+        self.conn.mark_busy()
+        for sector in range(0, len(image), self.FLASH_SECTOR_SIZE):
+            wanted = image[sector:sector + self.FLASH_SECTOR_SIZE]
+            t = time.monotonic()
+            current = self.read_flash(sector, len(wanted))
+            stats['read_time'] += time.monotonic() - t
+            blocks = range(0, len(wanted), size)
+            stats['blocks'] += len(blocks)
+            changed = [x for x in blocks if wanted[x:x + size] != current[x:x + size]]
+            if any(h & b != b for h, b in zip(current, wanted)):
+                if len(wanted) < self.FLASH_SECTOR_SIZE:
+                    t = time.monotonic()
+                    wanted += self.read_flash(sector + len(wanted), self.FLASH_SECTOR_SIZE - len(wanted))
+                    stats['read_time'] += time.monotonic() - t
+                t = time.monotonic()
+                ok = self.flash_erase(sector // self.ROM_BANK_SIZE, 0)
+                stats['erase_time'] += time.monotonic() - t
+                stats['erased'] += 1
+                if not ok:
+                    stats['failed'].append(sector)
+                    continue
+                blank = b'\xFF' * size
+                changed = [x for x in range(0, len(wanted), size) if wanted[x:x + size] != blank]
+            stats['skipped'] += len(set(blocks) - set(changed))
+            for x in changed:
+                address = sector + x
+                block = wanted[x:x + size]
+                t = time.monotonic()
+                ok = self.flash_program(address // self.ROM_BANK_SIZE, address % self.ROM_BANK_SIZE, block)
+                stats['program_time'] += time.monotonic() - t
+                stats['programmed'] += 1
+                stats['bytes'] += len(block)
+                if not ok:
+                    stats['failed'].append(address)
+                if cb:
+                    cb(address, block)
+        self.unlock_flash(False)
         self.conn.mark_idle()
+        stats['time'] = time.monotonic() - start
+        stats['bytes_per_sec'] = stats['bytes'] / stats['time'] if stats['time'] else None
+        return stats
 
 class MBC7(MBC):
     ACCEL_OFFSET = 0x81D0
+    # ERAL and WRAL can take several milliseconds
+    EEPROM_TIMEOUT = 0.1
 
     EWDS = (0, 0, 0, 0)
     WRAL = (0, 0, 0, 1)
@@ -233,6 +566,13 @@ class MBC7(MBC):
     READ = (1, 0)
     ERASE = (1, 1)
 
+    # A080 values that clock one bit in, and all eight bits of a byte, MSB first
+    SHIFT_BITS = ((0x80, 0xC0), (0x82, 0xC2))
+    SHIFT_BYTE = [tuple(v for i in range(7, -1, -1)
+                        for v in ((0x82, 0xC2) if (byte >> i) & 1 else (0x80, 0xC0)))
+                  for byte in range(256)]
+    BIT_WEIGHTS = [1 << i for i in range(15, -1, -1)]
+
     def unlock_ram(self):
         super(MBC7, self).unlock_ram()
         self.select_ram_bank(0x40)
@@ -287,83 +627,294 @@ class MBC7(MBC):
         for i in range(7, -1, -1):
             self.eeprom_shift_in(addr >> i)
 
-    def eeprom_wait(self):
-        # Clock the EEPROM while it's still doing stuff
-        while self.eeprom_shift_inout(0) == (0,):
-            pass
+    def eeprom_wait(self, timeout=None):
+        # Dropping CS starts the write; once CS is raised again, DO reads 0
+        # until the EEPROM has finished
+        self.conn.write_batch([(0xA080, 0), (0xA080, 0x80)], verify=False, replay=False)
+        deadline = time.monotonic() + (timeout or self.EEPROM_TIMEOUT)
+        while not self.conn.read(0xA080)[0] & 1:
+            if time.monotonic() > deadline:
+                return False
+        return True
+
+    def eeprom_compile(self, header, address=0, data=None, outputs=0):
+        # Turn a whole EEPROM transaction into the list of values written
+        # to A080, with None wherever DO has to be sampled
+        ops = [0, 0x80]
+        ops.extend(self.SHIFT_BITS[0])
+        ops.extend(self.SHIFT_BITS[1])
+        for b in header:
+            ops.extend(self.SHIFT_BITS[b])
+        if len(header) == 2:
+            ops.extend(self.SHIFT_BYTE[address & 0xFF])
+        else:
+            for b in range(10 - len(header)):
+                ops.extend(self.SHIFT_BITS[0])
+        if data is not None:
+            ops.extend(self.SHIFT_BYTE[data >> 8])
+            ops.extend(self.SHIFT_BYTE[data & 0xFF])
+        for i in range(outputs):
+            ops.extend(self.SHIFT_BITS[0])
+            ops.append(None)
+        # Rewriting the value A080 already holds doesn't clock anything
+        compiled = []
+        for op in ops:
+            if op is None or not compiled or compiled[-1] != op:
+                compiled.append(op)
+        return compiled
+
+    def eeprom_run(self, ops):
+        # Replaying part of a transaction would clock in extra bits, so after
+        # an echo error start over; the leading CS low aborts the old one
+        for attempt in range(self.conn.COMMAND_RETRIES):
+            try:
+                return self.eeprom_run_once(ops)
+            except IOError:
+                pass
+        return self.eeprom_run_once(ops)
+
+    def eeprom_run_once(self, ops):
+        bits = []
+        writes = []
+        for op in ops:
+            if op is not None:
+                writes.append((0xA080, op))
+                continue
+            self.conn.write_batch(writes, verify=False, replay=False)
+            writes = []
+            bits.append(self.conn.read(0xA080)[0] & 1)
+        self.conn.write_batch(writes, verify=False, replay=False)
+        return bits
 
     def ram_read(self, address):
-        self.eeprom_send_command(self.READ, address)
-        bs = self.eeprom_shift_outs(16)
-        b = 0
-        for i in range(len(bs)):
-            b |= bs[i] << (15 - i)
-        return b
+        bits = self.eeprom_run(self.eeprom_compile(self.READ, address, outputs=16))
+        word = 0
+        for weight, bit in zip(self.BIT_WEIGHTS, bits):
+            if bit:
+                word |= weight
+        return word
 
     def enable_write(self):
-        self.eeprom_send_command(self.EWEN)
+        self.eeprom_run(self.eeprom_compile(self.EWEN))
 
     def disable_write(self):
-        self.eeprom_send_command(self.EWDS)
+        self.eeprom_run(self.eeprom_compile(self.EWDS))
 
     def ram_write(self, address, word):
-        self.eeprom_send_command(self.WRITE, address)
-        # FIXME: Is there a prettier way to do this?
-        bs = [ord(x) - ord('0') for x in '{:016b}'.format(word)]
-        self.eeprom_shift_ins(bs)
-        self.eeprom_wait()
+        self.eeprom_run(self.eeprom_compile(self.WRITE, address, word))
+        return self.eeprom_wait()
 
     def dump_ram(self):
         self.conn.mark_busy()
-        bstring = b''
+        ram = bytearray(0x100)
         for i in range(0x80):
             word = self.ram_read(i)
-            bstring += chr(word >> 8)
-            bstring += chr(word & 0xFF)
+            ram[i * 2] = word >> 8
+            ram[i * 2 + 1] = word & 0xFF
         self.conn.mark_idle()
-        return bstring
+        return bytes(ram)
 
-    def restore_ram(self, ram):
+    def restore_ram(self, ram, diff=True):
+        # A uniform image is written with a single ERAL or WRAL. Otherwise,
+        # with diff set, only words that differ from the EEPROM are written.
+        # Returns False if the EEPROM stayed busy after a write.
+        words = [(ram[i * 2] << 8) | ram[i * 2 + 1] for i in range(0x80)]
         self.conn.mark_busy()
+        if words.count(words[0]) == len(words):
+            self.enable_write()
+            if words[0] == 0xFFFF:
+                self.eeprom_run(self.eeprom_compile(self.ERAL))
+            else:
+                self.eeprom_run(self.eeprom_compile(self.WRAL, data=words[0]))
+            ok = self.eeprom_wait()
+            self.disable_write()
+            self.conn.mark_idle()
+            return ok
+        current = [None] * 0x80
+        if diff:
+            current = [self.ram_read(i) for i in range(0x80)]
         self.enable_write()
+        ok = True
         for i in range(0x80):
-            word = ram[i * 2] << 8
-            word += ram[i * 2 + 1]
-            self.ram_write(i, word)
+            if current[i] != words[i]:
+                ok = self.ram_write(i, words[i]) and ok
         self.disable_write()
         self.conn.mark_idle()
+        return ok
+
+class CameraRegisters(object):
+    # Host copy of the camera sensor registers at A001-A035. Assignments
+    # are held until flush(), which writes only the registers that differ
+    # from what the camera was last sent. The registers can't be read
+    # back, so writes aren't verified.
+    SIZE = 0x36
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.values = bytearray(self.SIZE)
+        self.pending = {}
+        self.stats = {'written': 0, 'skipped': 0}
+        self.invalidate()
+
+    def invalidate(self):
+        self.synced = [False] * self.SIZE
+
+    def __getitem__(self, index):
+        return self.pending.get(index, self.values[index])
+
+    def known(self, index):
+        # Whether the register's value on the camera is known
+        return index in self.pending or self.synced[index]
+
+    def __setitem__(self, index, value):
+        if not 0 < index < self.SIZE:
+            raise IndexError('camera register out of range: %d' % index)
+        self.pending[index] = value & 0xFF
+
+    def flush(self):
+        writes = []
+        for index, value in sorted(self.pending.items()):
+            if self.synced[index] and self.values[index] == value:
+                self.stats['skipped'] += 1
+                continue
+            writes.append((0xA000 + index, value))
+        self.pending = {}
+        if writes:
+            self.camera.select_camera()
+            self.camera.conn.write_batch(writes, verify=False)
+            for address, value in writes:
+                self.values[address - 0xA000] = value
+                self.synced[address - 0xA000] = True
+            self.stats['written'] += len(writes)
+        return len(writes)
+
 
 class GBCamera(MBC):
+    WIDTH = 128
+    HEIGHT = 112
+    IMAGE_OFFSET = 0x100
+    CAPTURE_TIMEOUT = 2
+    CAPTURE_POLL = 0.05
+    EXPOSURE = 0x1000
+    EXPOSURE_TARGET = 1.5
+    PLANE = tuple(sum(((b >> (7 - i)) & 1) << (8 * (7 - i)) for i in range(8)) for b in range(256))
+
+    def __init__(self, conn):
+        super(GBCamera, self).__init__(conn)
+        self.sensor = CameraRegisters(self)
+
+    def invalidate(self):
+        super(GBCamera, self).invalidate()
+        self.sensor.invalidate()
+
     def select_camera(self):
         self.select_ram_bank(0x10)
 
     def set_camera_defaults(self):
-        self.set_exposure(0x1000)
+        self.set_exposure(self.EXPOSURE)
 
     def set_dither_matrix(self, matrix):
-        self.select_camera()
         for x in range(4):
             for y in range(4):
                 for l in range(3):
-                    self.conn.write(0xA006 + y * 3 + x * 12 + l, matrix[y][x][l])
+                    self.sensor[6 + y * 3 + x * 12 + l] = matrix[y][x][l]
+        self.sensor.flush()
+
+    def get_exposure(self):
+        # None until the exposure has been set through this object
+        if not (self.sensor.known(2) and self.sensor.known(3)):
+            return None
+        return (self.sensor[2] << 8) | self.sensor[3]
 
     def set_exposure(self, value):
-        self.select_camera()
-        self.conn.write(0xA002, value >> 8)
-        self.conn.write(0xA003, value & 0xFF)
+        self.sensor[2] = value >> 8
+        self.sensor[3] = value & 0xFF
+        self.sensor.flush()
+
+    def adjust_exposure(self, frame, target=None):
+        # Scale exposure towards the target mean brightness (0 is black,
+        # 3 is white), at most doubling or halving it per frame
+        if target is None:
+            target = self.EXPOSURE_TARGET
+        exposure = self.get_exposure()
+        if exposure is None:
+            # Nothing to scale from; start over from the default
+            self.set_exposure(self.EXPOSURE)
+            return self.EXPOSURE
+        if not frame:
+            return exposure
+        brightness = 3 - sum(frame) / float(len(frame))
+        factor = min(2.0, max(0.5, (target + 0.1) / (brightness + 0.1)))
+        exposure = min(0xFFFF, max(1, int(exposure * factor)))
+        self.set_exposure(exposure)
+        return exposure
+
+    def wait_photo(self, timeout=None):
+        # Captures take tens of milliseconds, so start polling quickly
+        # and back off up to CAPTURE_POLL
+        deadline = time.monotonic() + (timeout or self.CAPTURE_TIMEOUT)
+        delay = 0.001
+        while ord(self.conn.read_ec(0xA000)) & 1:
+            if time.monotonic() > deadline:
+                return False
+            self.conn.pacer.sleep(delay)
+            delay = min(self.CAPTURE_POLL, delay * 2)
+        return True
 
     def take_photo(self):
         self.conn.mark_busy()
         self.select_camera()
         self.conn.write(0xA000, 1)
-        while ord(self.conn.read_ec(0xA000)) & 1:
-           time.sleep(0.05)
+        ok = self.wait_photo()
         self.conn.mark_idle()
+        return ok
+
+    def read_photo(self):
+        self.select_ram_bank(0)
+        return self.conn.read_ec(0xA000 + self.IMAGE_OFFSET, self.WIDTH * self.HEIGHT // 4)
+
+    @classmethod
+    def decode_photo(cls, data, frame=None):
+        # Each tile row is a low and a high bit plane byte; PLANE spreads a
+        # byte's bits out to one byte per pixel so a row is two lookups.
+        width = cls.WIDTH
+        if frame is None:
+            frame = bytearray(width * cls.HEIGHT)
+        plane = cls.PLANE
+        for i in range(0, len(data), 2):
+            tile, row = divmod(i >> 1, 8)
+            ty, tx = divmod(tile, width >> 3)
+            offset = ((ty << 3) + row) * width + (tx << 3)
+            pixels = plane[data[i]] | (plane[data[i + 1]] << 1)
+            frame[offset:offset + 8] = pixels.to_bytes(8, 'big')
+        return frame
+
+    def capture_stream(self, count=None, auto_exposure=False):
+        # Yields (timestamp, fps, frame) for each capture; frame is a
+        # WIDTH * HEIGHT bytearray of 2-bit colour values.
+        self.conn.mark_busy()
+        try:
+            start = time.monotonic()
+            n = 0
+            while count is None or n < count:
+                self.select_camera()
+                self.conn.write(0xA000, 1)
+                if not self.wait_photo():
+                    return
+                frame = self.decode_photo(self.read_photo())
+                if auto_exposure:
+                    self.adjust_exposure(frame)
+                n += 1
+                now = time.monotonic()
+                yield now, n / (now - start), frame
+        finally:
+            self.conn.mark_idle()
 
 class TAMA5(MBC):
     def __init__(self, conn):
         super(TAMA5, self).__init__(conn)
         self.ramsize = 0x20
+        self.nibbles = {}
 
     def unlock_ram(self):
         self.conn.write(0xA001, 0xA)
@@ -381,43 +932,87 @@ class TAMA5(MBC):
     def select_ram_bank(self, bank):
         pass
 
-    def dump_ram(self):
+    def set_nibbles(self, values, writes=None):
+        # Queue writes to the registers behind the A001 index, skipping
+        # the ones that already hold the value. Register 7 starts a RAM
+        # access, so it is always written.
+        if writes is None:
+            writes = []
+        for reg, value in values:
+            if reg != 7 and self.nibbles.get(reg) == value:
+                continue
+            writes.append((0xA001, reg))
+            writes.append((0xA000, value))
+            self.nibbles[reg] = value
+        return writes
+
+    def invalidate(self):
+        super(TAMA5, self).invalidate()
+        self.nibbles = {}
+
+    def dump_ram(self, limit=None):
+        # Read the image twice and re-read the bytes that disagree until
+        # two reads in a row match
         self.conn.mark_busy()
         self.unlock_ram()
-        ram = []
-        for i in range(self.ramsize):
-            self.conn.write(0xA001, 6)
-            self.conn.write(0xA000, (i >> 4) + 2)
-            self.conn.write(0xA001, 7)
-            self.conn.write(0xA000, i & 0xF)
-            self.conn.write(0xA001, 0xD)
-            hi = ord(self.conn.read_ec(0xA000)) & 0xF
-            self.conn.write(0xA001, 0xC)
-            lo = ord(self.conn.read_ec(0xA000)) & 0xF
-            ram.append((hi << 4) | lo)
+        self.nibbles = {}
+        ram = self.read_ram()
+        pending = range(self.ramsize)
+        retries = 0
+        while pending:
+            check = self.read_ram(pending)
+            pending = [i for i in pending if check[i] != ram[i]]
+            for i in pending:
+                ram[i] = check[i]
+            retries += 1
+            if limit is not None and limit > 0 and retries > limit:
+                break
         self.conn.mark_idle()
         return bytes(ram)
 
-    def restore_ram(self, ram):
+    def read_ram(self, indices=None):
+        if indices is None:
+            indices = range(self.ramsize)
+        ram = bytearray(self.ramsize)
+        for i in indices:
+            writes = self.set_nibbles([(6, (i >> 4) + 2), (7, i & 0xF)])
+            writes.append((0xA001, 0xD))
+            self.conn.write_batch(writes, verify=False)
+            hi = self.conn.read(0xA000)[0] & 0xF
+            self.conn.write(0xA001, 0xC)
+            lo = self.conn.read(0xA000)[0] & 0xF
+            ram[i] = (hi << 4) | lo
+        return ram
+
+    def restore_ram(self, ram, limit=None):
+        # The data registers sit behind the A001 index register, so the
+        # writes can't be read back directly; verify with read_ram instead
         self.conn.mark_busy()
         self.unlock_ram()
-        for i in range(self.ramsize):
-            self.conn.write(0xA001, 4)
-            self.conn.write(0xA000, i & 0xF)
-            self.conn.write(0xA001, 5)
-            self.conn.write(0xA000, i >> 4)
-            self.conn.write(0xA001, 6)
-            self.conn.write(0xA000, i >> 4)
-            self.conn.write(0xA001, 7)
-            self.conn.write(0xA000, i & 0xF)
+        self.nibbles = {}
+        pending = range(self.ramsize)
+        retries = 0
+        while pending:
+            writes = []
+            for i in pending:
+                self.set_nibbles([(4, ram[i] & 0xF), (5, ram[i] >> 4), (6, i >> 4), (7, i & 0xF)], writes)
+            self.conn.write_batch(writes, verify=False)
+            current = self.read_ram()
+            pending = [i for i in range(self.ramsize) if current[i] != ram[i]]
+            if pending:
+                self.nibbles = {}
+            retries += 1
+            if limit is not None and limit > 0 and retries > limit:
+                break
         self.conn.mark_idle()
+        return not pending
 
 class HuC1(MBC):
     pass
 
 class HuC3(HuC1):
     def select_rom_bank(self, bank):
-        self.conn.write(0x2000, bank)
+        self.set_register(0x2000, bank)
 
 
 MAPPINGS = {
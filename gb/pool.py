@@ -0,0 +1,143 @@
+import queue
+import threading
+import time
+
+from . import conn, mbc
+
+
+class Job(object):
+    KINDS = ('dump_rom', 'dump_ram', 'restore_ram')
+
+    def __init__(self, port, kind, path=None, data=None):
+        if kind not in self.KINDS:
+            raise ValueError('Unknown job kind: %s' % kind)
+        self.port = port
+        self.kind = kind
+        self.path = path
+        self.data = data
+        self.gamename = None
+        self.result = None
+        self.error = None
+        self.elapsed = None
+        self.finished = threading.Event()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+
+class CartPool(object):
+    # Runs jobs on several links at once, one worker thread per link. Each
+    # job connects afresh, so carts can be swapped between jobs, and a job
+    # that fails only affects its own port. Ports without a pacer in pacers
+    # get one loaded by port name from path (Pacer.PATH by default), which
+    # is saved back after every job.
+    def __init__(self, links, pacers=None, path=None):
+        self.links = dict(links)
+        self.pacers = dict(pacers or {})
+        self.path = path
+        self.queues = {port: queue.Queue() for port in self.links}
+        self.workers = {}
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.loaded = set()
+        self.progress = {}
+        for port in self.links:
+            self.progress[port] = {'state': 'idle', 'job': None, 'done': 0, 'total': 0,
+                                   'bytes': 0, 'time': 0, 'jobs': 0, 'failures': 0, 'error': None}
+
+    def start(self):
+        for port in self.links:
+            if port not in self.workers:
+                worker = threading.Thread(target=self._work, args=(port,), name='gb-%s' % port)
+                worker.daemon = True
+                worker.start()
+                self.workers[port] = worker
+
+    def stop(self, wait=True):
+        for port in self.workers:
+            self.queues[port].put(None)
+        if wait:
+            for worker in self.workers.values():
+                worker.join()
+        self.workers = {}
+
+    def submit(self, port, kind, path=None, data=None):
+        job = Job(port, kind, path, data)
+        self.queues[port].put(job)
+        return job
+
+    def snapshot(self):
+        with self.lock:
+            stats = {port: dict(p) for port, p in self.progress.items()}
+        for p in stats.values():
+            p['bytes_per_sec'] = p['bytes'] / p['time'] if p['time'] else None
+        return stats
+
+    def _update(self, port, **values):
+        with self.lock:
+            self.progress[port].update(values)
+
+    def _work(self, port):
+        while True:
+            job = self.queues[port].get()
+            if job is None:
+                break
+            self._update(port, state='running', job=job.kind, done=0, total=0, error=None)
+            start = time.monotonic()
+            try:
+                job.result = self._run(port, job)
+                if job.result is False:
+                    raise IOError('%s did not verify on %s' % (job.kind, port))
+                size = len(job.result) if job.kind != 'restore_ram' else len(job.data)
+                with self.lock:
+                    p = self.progress[port]
+                    p['bytes'] += size
+                    p['time'] += time.monotonic() - start
+                    p['jobs'] += 1
+                    p['state'] = 'idle'
+            except Exception as e:
+                job.error = '%s: %s' % (type(e).__name__, e)
+                with self.lock:
+                    p = self.progress[port]
+                    p['failures'] += 1
+                    p['state'] = 'failed'
+                    p['error'] = job.error
+            if port in self.loaded:
+                try:
+                    with self.save_lock:
+                        self.pacers[port].save()
+                except (IOError, OSError):
+                    # Losing the gaps only costs the next job its warm-up
+                    pass
+            job.elapsed = time.monotonic() - start
+            job.finished.set()
+
+    def _run(self, port, job):
+        if port not in self.pacers:
+            self.pacers[port] = conn.Pacer.load(port, path=self.path)
+            self.loaded.add(port)
+        dl = conn.detect_link(self.links[port], self.pacers[port])
+        if dl is None:
+            raise IOError('No cart detected on %s' % port)
+        m = mbc.detect(dl)
+        if m is None:
+            raise IOError('Unsupported cart type 0x%02X on %s' % (dl.carttype, port))
+        job.gamename = dl.gamename
+
+        if job.kind == 'dump_rom':
+            self._update(port, total=m.nbanks)
+
+            def progress(i, data):
+                self._update(port, done=i + 1)
+            result = m.dump_rom(progress)
+        elif job.kind == 'dump_ram':
+            m.unlock_ram()
+            result = m.dump_ram()
+        else:
+            m.unlock_ram()
+            result = m.restore_ram(job.data)
+
+        if job.path and job.kind != 'restore_ram':
+            with open(job.path, 'wb') as f:
+                f.write(result)
+        return result
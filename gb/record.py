@@ -0,0 +1,151 @@
+import struct
+import time
+
+from . import conn
+
+MAGIC = b'GBLR\x01'
+# kind, microseconds since the recording started, byte count
+RECORD = struct.Struct('<BQI')
+TX = 0
+TXB = 1
+RXB = 2
+KINDS = ('tx', 'txb', 'rxb')
+
+
+class LinkRecorder(object):
+    # Wraps a link (LinkSerial, LinkBridge, LinkParallel, ...) and logs
+    # every exchange to a file. Each record is a header followed by the
+    # bytes sent (left out for rxb, which sends zeros) and the bytes
+    # received.
+    def __init__(self, link, path):
+        self.link = link
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.start = time.monotonic()
+        self.records = 0
+
+    def __getattr__(self, name):
+        return getattr(self.link, name)
+
+    # LinkDL.set_trace has to reach the wrapped link
+    @property
+    def trace(self):
+        return getattr(self.link, 'trace', None)
+
+    @trace.setter
+    def trace(self, trace):
+        self.link.trace = trace
+
+    def _log(self, kind, sent, received):
+        t = int((time.monotonic() - self.start) * 1000000)
+        self.f.write(RECORD.pack(kind, t, len(received)))
+        if sent is not None:
+            self.f.write(sent[:len(received)])
+        self.f.write(received)
+        self.records += 1
+
+    def tx(self, byte):
+        b = self.link.tx(byte)
+        self._log(TX, bytes([byte]), bytes([b]))
+        return b
+
+    def rx(self):
+        return self.tx(0)
+
+    def txb(self, block):
+        block = bytes(block)
+        data = self.link.txb(block)
+        self._log(TXB, block, data)
+        return data
+
+    def rxb(self, n=1):
+        data = self.link.rxb(n)
+        self._log(RXB, None, data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load(path):
+    # Returns a list of (kind, seconds, sent, received)
+    records = []
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a link recording: %s' % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            kind, t, n = RECORD.unpack(header)
+            sent = bytes(n) if kind == RXB else f.read(n)
+            received = f.read(n)
+            if len(sent) < n or len(received) < n:
+                break
+            records.append((KINDS[kind], t / 1000000.0, sent, received))
+    return records
+
+
+class LinkReplay(object):
+    # Plays a recording back as a link, as fast as it is asked. The link is
+    # byte synchronous, so the recording is treated as one stream of
+    # exchanged bytes: replaying with a different mix of tx, txb and rxb
+    # calls works as long as the same bytes are sent. With strict set, a
+    # byte that differs from the recording raises ValueError.
+    PACED = True
+
+    def __init__(self, path, strict=True):
+        self.records = load(path)
+        self.sent = b''.join(r[2] for r in self.records)
+        self.received = b''.join(r[3] for r in self.records)
+        self.strict = strict
+        self.pos = 0
+        self.mismatches = 0
+
+    def rewind(self):
+        self.pos = 0
+        self.mismatches = 0
+
+    def remaining(self):
+        return len(self.received) - self.pos
+
+    def _exchange(self, sent):
+        start = self.pos
+        end = start + len(sent)
+        if end > len(self.received):
+            raise EOFError('Replay ran past the end of the recording')
+        if sent != self.sent[start:end]:
+            self.mismatches += 1
+            if self.strict:
+                raise ValueError('Replay diverged from the recording at byte %d' % start)
+        self.pos = end
+        return self.received[start:end]
+
+    def tx(self, byte):
+        return self._exchange(bytes([byte]))[0]
+
+    def rx(self):
+        return self.tx(0)
+
+    def txb(self, block):
+        return self._exchange(bytes(block))
+
+    def rxb(self, n=1):
+        return self._exchange(bytes(n))
+
+
+class ReplayPacer(conn.Pacer):
+    # Keeps the gap bookkeeping so pacing changes can be compared, but
+    # never waits or sleeps; use with LinkReplay to rerun a session at
+    # full speed
+    def wait(self, cls):
+        pass
+
+    def sleep(self, seconds):
+        pass
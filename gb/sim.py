@@ -0,0 +1,886 @@
+import os
+import random
+import select
+import threading
+import time
+
+HANDSHAKE_DL = 0x9A
+HANDSHAKE_LINK2 = 0x99
+
+RAM_SIZES = {
+    1: 0x800,
+    2: 0x2000,
+    3: 0x8000,
+    4: 0x20000,
+    5: 0x10000,
+}
+
+
+def rom_banks(romsize):
+    if romsize < 8:
+        return 2 << romsize
+    return {0x52: 72, 0x53: 80, 0x54: 96}[romsize]
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def build_rom(carttype=0x00, romsize=0, ramsize=0, title='SIMULATED', seed=0):
+    size = rom_banks(romsize) * 0x4000
+    rom = bytearray(random_bytes(size, seed))
+    rom[0x134:0x144] = title.encode('ascii')[:16].ljust(16, b'\0')
+    rom[0x147] = carttype
+    rom[0x148] = romsize
+    rom[0x149] = ramsize
+    x = 0
+    for b in rom[0x134:0x14D]:
+        x = (x - b - 1) & 0xFF
+    rom[0x14D] = x
+    rom[0x14E:0x150] = b'\0\0'
+    checksum = sum(rom) & 0xFFFF
+    rom[0x14E] = checksum >> 8
+    rom[0x14F] = checksum & 0xFF
+    return bytes(rom)
+
+
+class Cartridge(object):
+    ROM_BANK_SIZE = 0x4000
+    RAM_BANK_SIZE = 0x2000
+
+    def __init__(self, rom, ram=None):
+        self.rom = bytes(rom)
+        self.carttype = self.rom[0x147]
+        self.romsize = self.rom[0x148]
+        self.ramsize = self.rom[0x149]
+        self.checksum = (self.rom[0x14E] << 8) | self.rom[0x14F]
+        self.ram = bytearray(self.ram_size())
+        if ram:
+            self.load_ram(ram)
+        self.ram_enabled = True
+        self.bank0 = 0
+        self.rom_bank = 1
+        self.ram_bank = 0
+
+    def ram_size(self):
+        return RAM_SIZES.get(self.ramsize, 0)
+
+    def load_ram(self, ram):
+        self.ram[:len(ram)] = ram
+
+    def header(self):
+        return bytes([self.carttype, self.romsize, self.ramsize,
+                      self.checksum >> 8, self.checksum & 0xFF]) + self.rom[0x134:0x144]
+
+    def map_rom(self, address):
+        # Returns (ROM offset, end of the mapped region) or None if the
+        # address isn't backed by plain ROM
+        if address < 0x4000:
+            return self.bank0 * self.ROM_BANK_SIZE + address, 0x4000
+        return self.rom_bank * self.ROM_BANK_SIZE + address - 0x4000, 0x8000
+
+    def read(self, address):
+        if address < 0x8000:
+            mapped = self.map_rom(address)
+            if mapped is None:
+                return self.read_register(address)
+            return self.rom[mapped[0] % len(self.rom)]
+        if 0xA000 <= address < 0xC000:
+            return self.read_ram(address - 0xA000)
+        return 0xFF
+
+    def read_block(self, address, length):
+        out = bytearray()
+        end = address + length
+        while address < end:
+            mapped = self.map_rom(address) if address < 0x8000 else None
+            if mapped is None:
+                out.append(self.read(address & 0xFFFF))
+                address += 1
+                continue
+            offset = mapped[0] % len(self.rom)
+            span = min(end, mapped[1]) - address
+            span = min(span, len(self.rom) - offset)
+            out += self.rom[offset:offset + span]
+            address += span
+        return bytes(out)
+
+    def read_register(self, address):
+        return 0xFF
+
+    def read_ram(self, offset):
+        if not self.ram_enabled or not self.ram:
+            return 0xFF
+        return self.ram[(self.ram_bank * self.RAM_BANK_SIZE + offset) % len(self.ram)]
+
+    def write(self, address, value):
+        if address < 0x8000:
+            self.write_register(address, value)
+        elif 0xA000 <= address < 0xC000:
+            self.write_ram(address - 0xA000, value)
+
+    def write_register(self, address, value):
+        pass
+
+    def write_ram(self, offset, value):
+        if not self.ram_enabled or not self.ram:
+            return
+        self.ram[(self.ram_bank * self.RAM_BANK_SIZE + offset) % len(self.ram)] = value
+
+
+class MBC(Cartridge):
+    pass
+
+
+class MBC1(Cartridge):
+    def __init__(self, rom, ram=None):
+        super(MBC1, self).__init__(rom, ram)
+        self.ram_enabled = False
+        self.bank_lo = 1
+        self.bank_hi = 0
+        self.mode = 0
+
+    def write_register(self, address, value):
+        if address < 0x2000:
+            self.ram_enabled = (value & 0xF) == 0xA
+        elif address < 0x4000:
+            self.bank_lo = (value & 0x1F) or 1
+        elif address < 0x6000:
+            self.bank_hi = value & 3
+        else:
+            self.mode = value & 1
+        self.rom_bank = (self.bank_hi << 5) | self.bank_lo
+        self.bank0 = self.bank_hi << 5 if self.mode else 0
+        self.ram_bank = self.bank_hi if self.mode else 0
+
+
+class MBC2(Cartridge):
+    def __init__(self, rom, ram=None):
+        super(MBC2, self).__init__(rom, ram)
+        self.ram_enabled = False
+
+    def ram_size(self):
+        return 0x200
+
+    def load_ram(self, ram):
+        if len(ram) <= 0x100:
+            # Packed two nibbles per byte, as returned by mbc.MBC2.dump_ram
+            for i, b in enumerate(ram):
+                self.ram[i * 2] = b & 0xF
+                self.ram[i * 2 + 1] = b >> 4
+        else:
+            for i, b in enumerate(ram[:0x200]):
+                self.ram[i] = b & 0xF
+
+    def write_register(self, address, value):
+        if address >= 0x4000:
+            return
+        if address & 0x100:
+            self.rom_bank = (value & 0xF) or 1
+        else:
+            self.ram_enabled = (value & 0xF) == 0xA
+
+    def read_ram(self, offset):
+        if not self.ram_enabled:
+            return 0xFF
+        return 0xF0 | self.ram[offset & 0x1FF]
+
+    def write_ram(self, offset, value):
+        if self.ram_enabled:
+            self.ram[offset & 0x1FF] = value & 0xF
+
+
+class MBC3(Cartridge):
+    def __init__(self, rom, ram=None, clock=time.time):
+        super(MBC3, self).__init__(rom, ram)
+        self.ram_enabled = False
+        self.clock = clock
+        self.rtc_base = clock()
+        self.rtc_halted = None
+        self.rtc_latched = [0] * 5
+        self.latch = None
+
+    def rtc_seconds(self):
+        if self.rtc_halted is not None:
+            return self.rtc_halted
+        return int(self.clock() - self.rtc_base)
+
+    def rtc_registers(self):
+        total = self.rtc_seconds()
+        days = total // 86400
+        dh = (days >> 8) & 1
+        if self.rtc_halted is not None:
+            dh |= 0x40
+        if days > 0x1FF:
+            dh |= 0x80
+        return [total % 60, (total // 60) % 60, (total // 3600) % 24, days & 0xFF, dh]
+
+    def set_rtc_register(self, reg, value):
+        regs = self.rtc_registers()
+        regs[reg] = value
+        total = (((regs[4] & 1) << 8 | regs[3]) * 86400 + (regs[2] % 24) * 3600 +
+                 (regs[1] % 60) * 60 + regs[0] % 60)
+        if regs[4] & 0x40:
+            self.rtc_halted = total
+        else:
+            self.rtc_halted = None
+            self.rtc_base = self.clock() - total
+
+    def write_register(self, address, value):
+        if address < 0x2000:
+            self.ram_enabled = (value & 0xF) == 0xA
+        elif address < 0x4000:
+            self.rom_bank = (value & 0x7F) or 1
+        elif address < 0x6000:
+            self.ram_bank = value & 0xF
+        else:
+            if self.latch == 0 and value == 1:
+                self.rtc_latched = self.rtc_registers()
+            self.latch = value
+
+    def read_ram(self, offset):
+        if self.ram_enabled and 8 <= self.ram_bank <= 0xC:
+            return self.rtc_latched[self.ram_bank - 8]
+        if self.ram_bank > 3:
+            return 0xFF
+        return super(MBC3, self).read_ram(offset)
+
+    def write_ram(self, offset, value):
+        if self.ram_enabled and 8 <= self.ram_bank <= 0xC:
+            self.set_rtc_register(self.ram_bank - 8, value)
+        elif self.ram_bank <= 3:
+            super(MBC3, self).write_ram(offset, value)
+
+
+class MBC5(Cartridge):
+    def __init__(self, rom, ram=None):
+        super(MBC5, self).__init__(rom, ram)
+        self.ram_enabled = False
+        self.rumble = False
+
+    def write_register(self, address, value):
+        if address < 0x2000:
+            self.ram_enabled = (value & 0xF) == 0xA
+        elif address < 0x3000:
+            self.rom_bank = (self.rom_bank & 0x100) | value
+        elif address < 0x4000:
+            self.rom_bank = (self.rom_bank & 0xFF) | ((value & 1) << 8)
+        elif address < 0x6000:
+            if 0x1C <= self.carttype <= 0x1E:
+                self.rumble = bool(value & 8)
+                value &= 7
+            self.ram_bank = value & 0xF
+
+
+class MBC6(Cartridge):
+    ROM_BANK_SIZE = 0x2000
+    RAM_BANK_SIZE = 0x1000
+    FLASH_SIZE = 0x100000
+    # Sector erase clears 128 KiB, as on the MX29F008 the cart uses
+    FLASH_SECTOR_SIZE = 0x20000
+    FLASH_ID = (0xC2, 0x81)
+
+    def __init__(self, rom, ram=None, flash=None):
+        super(MBC6, self).__init__(rom, ram)
+        self.ram_enabled = False
+        self.banks = [2, 3]
+        self.ram_banks = [0, 1]
+        self.flash_mapped = [False, False]
+        self.flash = bytearray(b'\xFF' * self.FLASH_SIZE)
+        if flash:
+            self.flash[:len(flash)] = flash
+        self.flash_enabled = False
+        self.flash_writable = False
+        self.flash_state = 'read'
+        self.flash_unlock = 0
+        self.flash_buffer = {}
+
+    def ram_size(self):
+        return 0x8000
+
+    def map_rom(self, address):
+        if address < 0x4000:
+            return address, 0x4000
+        block = (address - 0x4000) >> 13
+        if self.flash_mapped[block]:
+            return None
+        return (self.banks[block] * self.ROM_BANK_SIZE + (address & 0x1FFF),
+                0x6000 + block * 0x2000)
+
+    def flash_address(self, address):
+        block = (address - 0x4000) >> 13
+        return (self.banks[block] * self.ROM_BANK_SIZE + (address & 0x1FFF)) % self.FLASH_SIZE
+
+    def read_register(self, address):
+        if self.flash_state == 'id':
+            return self.FLASH_ID[address & 1]
+        if self.flash_state == 'status':
+            return 0x80
+        return self.flash[self.flash_address(address)]
+
+    def write_register(self, address, value):
+        if address < 0x0400:
+            self.ram_enabled = (value & 0xF) == 0xA
+        elif address < 0x0800:
+            self.ram_banks[0] = value & 7
+        elif address < 0x0C00:
+            self.ram_banks[1] = value & 7
+        elif address < 0x1000:
+            if self.flash_writable:
+                self.flash_enabled = bool(value & 1)
+        elif address < 0x2000:
+            self.flash_writable = bool(value & 1)
+        elif address < 0x4000:
+            block = (address - 0x2000) >> 12
+            if address & 0x800:
+                self.flash_mapped[block] = bool(value & 8)
+            else:
+                self.banks[block] = value
+        elif self.flash_mapped[(address - 0x4000) >> 13]:
+            self.flash_write(self.flash_address(address), value)
+
+    def flash_write(self, address, value):
+        if self.flash_state == 'program':
+            if address in self.flash_buffer:
+                if self.flash_writable:
+                    for a, b in self.flash_buffer.items():
+                        self.flash[a] &= b
+                self.flash_buffer = {}
+                self.flash_state = 'status'
+            else:
+                self.flash_buffer[address] = value
+            return
+        if value == 0xF0:
+            self.flash_state = 'read'
+            self.flash_unlock = 0
+            return
+        if not self.flash_enabled:
+            return
+        if self.flash_unlock == 0:
+            if address == 0x5555 and value == 0xAA:
+                self.flash_unlock = 1
+            return
+        if self.flash_unlock == 1:
+            self.flash_unlock = 2 if address == 0x2AAA and value == 0x55 else 0
+            return
+        self.flash_unlock = 0
+        if self.flash_state == 'erase':
+            if not self.flash_writable:
+                self.flash_state = 'read'
+            elif value == 0x30:
+                sector = address & ~(self.FLASH_SECTOR_SIZE - 1)
+                self.flash[sector:sector + self.FLASH_SECTOR_SIZE] = b'\xFF' * self.FLASH_SECTOR_SIZE
+                self.flash_state = 'status'
+            elif value == 0x10:
+                self.flash[:] = b'\xFF' * self.FLASH_SIZE
+                self.flash_state = 'status'
+            return
+        if value == 0x90:
+            self.flash_state = 'id'
+        elif value == 0x80:
+            self.flash_state = 'erase'
+        elif value == 0xA0:
+            self.flash_state = 'program'
+            self.flash_buffer = {}
+
+    def read_ram(self, offset):
+        if not self.ram_enabled:
+            return 0xFF
+        bank = self.ram_banks[offset >> 12]
+        return self.ram[(bank * self.RAM_BANK_SIZE + (offset & 0xFFF)) % len(self.ram)]
+
+    def write_ram(self, offset, value):
+        if self.ram_enabled:
+            bank = self.ram_banks[offset >> 12]
+            self.ram[(bank * self.RAM_BANK_SIZE + (offset & 0xFFF)) % len(self.ram)] = value
+
+
+class MBC7(Cartridge):
+    ACCEL_CENTER = 0x81D0
+
+    def __init__(self, rom, ram=None):
+        self.eeprom = [0xFFFF] * 0x80
+        super(MBC7, self).__init__(rom, ram)
+        self.ram_enabled = False
+        self.ram_enabled2 = False
+        self.accel_x = 0
+        self.accel_y = 0
+        self.accel_latch = [0x8000, 0x8000]
+        self.eeprom_writable = False
+        self.eeprom_reg = 0
+        self.eeprom_reset()
+
+    def ram_size(self):
+        return 0
+
+    def load_ram(self, ram):
+        for i in range(min(len(ram) // 2, 0x80)):
+            self.eeprom[i] = (ram[i * 2] << 8) | ram[i * 2 + 1]
+
+    def dump_eeprom(self):
+        return b''.join(bytes([w >> 8, w & 0xFF]) for w in self.eeprom)
+
+    def eeprom_reset(self):
+        self.eeprom_bits = 0
+        self.eeprom_count = 0
+        self.eeprom_command = None
+        self.eeprom_out = []
+        self.eeprom_do = 1
+
+    def write_register(self, address, value):
+        if address < 0x2000:
+            self.ram_enabled = (value & 0xF) == 0xA
+        elif address < 0x4000:
+            self.rom_bank = value & 0x7F
+        elif address < 0x6000:
+            self.ram_enabled2 = value == 0x40
+
+    def read_ram(self, offset):
+        if not (self.ram_enabled and self.ram_enabled2) or offset >= 0x1000:
+            return 0xFF
+        reg = (offset >> 4) & 0xF
+        if 2 <= reg <= 5:
+            value = self.accel_latch[(reg - 2) >> 1]
+            return value >> 8 if reg & 1 else value & 0xFF
+        if reg == 6:
+            return 0
+        if reg == 8:
+            return (self.eeprom_reg & 0xC2) | self.eeprom_do
+        return 0xFF
+
+    def write_ram(self, offset, value):
+        if not (self.ram_enabled and self.ram_enabled2) or offset >= 0x1000:
+            return
+        reg = (offset >> 4) & 0xF
+        if reg == 0 and value == 0x55:
+            self.accel_latch = [0x8000, 0x8000]
+        elif reg == 1 and value == 0xAA:
+            self.accel_latch = [(self.ACCEL_CENTER + self.accel_x) & 0xFFFF,
+                                (self.ACCEL_CENTER + self.accel_y) & 0xFFFF]
+        elif reg == 8:
+            self.eeprom_write(value)
+
+    def eeprom_write(self, value):
+        old = self.eeprom_reg
+        self.eeprom_reg = value
+        if not value & 0x80:
+            self.eeprom_reset()
+            return
+        if old & 0x40 or not value & 0x40:
+            return
+        # Rising clock edge with chip select held
+        bit = (value >> 1) & 1
+        if self.eeprom_command is None:
+            if not self.eeprom_count and not bit:
+                # Waiting for the start bit
+                return
+            self.eeprom_bits = (self.eeprom_bits << 1) | bit
+            self.eeprom_count += 1
+            if self.eeprom_count == 11:
+                self.eeprom_decode()
+            return
+        if self.eeprom_command == 'read':
+            self.eeprom_do = self.eeprom_out.pop(0) if self.eeprom_out else 0
+            return
+        if self.eeprom_command in ('write', 'wral'):
+            self.eeprom_bits = (self.eeprom_bits << 1) | bit
+            self.eeprom_count += 1
+            if self.eeprom_count == 16:
+                if self.eeprom_writable:
+                    if self.eeprom_command == 'write':
+                        self.eeprom[self.eeprom_address] = self.eeprom_bits
+                    else:
+                        self.eeprom = [self.eeprom_bits] * 0x80
+                self.eeprom_command = 'done'
+                self.eeprom_do = 1
+            return
+        self.eeprom_do = 1
+
+    def eeprom_decode(self):
+        opcode = (self.eeprom_bits >> 8) & 3
+        address = self.eeprom_bits & 0x7F
+        sub = (self.eeprom_bits >> 6) & 3
+        self.eeprom_bits = 0
+        self.eeprom_count = 0
+        self.eeprom_address = address
+        self.eeprom_do = 0
+        if opcode == 2:
+            word = self.eeprom[address]
+            self.eeprom_out = [(word >> i) & 1 for i in range(15, -1, -1)]
+            self.eeprom_command = 'read'
+        elif opcode == 1:
+            self.eeprom_command = 'write'
+        elif opcode == 3:
+            if self.eeprom_writable:
+                self.eeprom[address] = 0xFFFF
+            self.eeprom_command = 'done'
+        else:
+            if sub == 0:
+                self.eeprom_writable = False
+            elif sub == 1:
+                self.eeprom_command = 'wral'
+                return
+            elif sub == 2:
+                if self.eeprom_writable:
+                    self.eeprom = [0xFFFF] * 0x80
+            else:
+                self.eeprom_writable = True
+            self.eeprom_command = 'done'
+
+
+class GBCamera(Cartridge):
+    WIDTH = 128
+    HEIGHT = 112
+    IMAGE_OFFSET = 0x100
+
+    def __init__(self, rom, ram=None, scene=None):
+        super(GBCamera, self).__init__(rom, ram)
+        self.ram_enabled = False
+        self.registers = bytearray(0x80)
+        self.scene = scene
+        self.frame = 0
+        self.capture_polls = 2
+        self.capture_left = 0
+
+    def ram_size(self):
+        return 0x20000
+
+    def write_register(self, address, value):
+        if address < 0x2000:
+            self.ram_enabled = (value & 0xF) == 0xA
+        elif address < 0x4000:
+            self.rom_bank = value & 0x3F
+        elif address < 0x6000:
+            self.ram_bank = value & 0x1F
+
+    def read_ram(self, offset):
+        if self.ram_bank & 0x10:
+            if offset & 0x7F:
+                return 0
+            if self.capture_left:
+                self.capture_left -= 1
+                if not self.capture_left:
+                    self.capture()
+            return self.registers[0] & 0x06 | (1 if self.capture_left else 0)
+        return super(GBCamera, self).read_ram(offset)
+
+    def write_ram(self, offset, value):
+        if self.ram_bank & 0x10:
+            self.registers[offset & 0x7F] = value
+            if not offset & 0x7F and value & 1:
+                self.capture_left = self.capture_polls
+            return
+        super(GBCamera, self).write_ram(offset, value)
+
+    def sample(self, x, y):
+        if self.scene is not None:
+            return self.scene(x, y, self.frame)
+        return (x * 2 + y + self.frame * 4) & 0xFF
+
+    def capture(self):
+        exposure = (self.registers[2] << 8) | self.registers[3]
+        image = bytearray(self.WIDTH * self.HEIGHT // 4)
+        for y in range(self.HEIGHT):
+            for x in range(self.WIDTH):
+                level = min(255, self.sample(x, y) * exposure // 0x1000)
+                base = 6 + (x & 3) * 12 + (y & 3) * 3
+                color = 3
+                for threshold in self.registers[base:base + 3]:
+                    if level >= threshold:
+                        color -= 1
+                tile = (y >> 3) * (self.WIDTH >> 3) + (x >> 3)
+                index = tile * 16 + (y & 7) * 2
+                bit = 0x80 >> (x & 7)
+                if color & 1:
+                    image[index] |= bit
+                if color & 2:
+                    image[index + 1] |= bit
+        self.ram[self.IMAGE_OFFSET:self.IMAGE_OFFSET + len(image)] = image
+        self.frame += 1
+
+
+class TAMA5(Cartridge):
+    def __init__(self, rom, ram=None):
+        super(TAMA5, self).__init__(rom, ram)
+        self.registers = [0] * 16
+        self.register = 0
+        self.result = 0
+
+    def ram_size(self):
+        return 0x20
+
+    def read_ram(self, offset):
+        if offset & 1:
+            return 0xFF
+        if self.register == 0xA:
+            return 0xF1
+        if self.register == 0xC:
+            return 0xF0 | (self.result & 0xF)
+        if self.register == 0xD:
+            return 0xF0 | (self.result >> 4)
+        return 0xFF
+
+    def write_ram(self, offset, value):
+        if offset & 1:
+            self.register = value & 0xF
+            return
+        value &= 0xF
+        self.registers[self.register] = value
+        if self.register in (0, 1):
+            self.rom_bank = (self.registers[1] << 4) | self.registers[0]
+        elif self.register == 7:
+            address = ((self.registers[6] & 1) << 4) | value
+            command = self.registers[6] >> 1
+            if command == 0:
+                self.ram[address] = (self.registers[5] << 4) | self.registers[4]
+            elif command == 1:
+                self.result = self.ram[address]
+
+
+class HuC1(Cartridge):
+    def __init__(self, rom, ram=None):
+        super(HuC1, self).__init__(rom, ram)
+        self.ram_enabled = False
+
+    def write_register(self, address, value):
+        if address < 0x2000:
+            self.ram_enabled = (value & 0xF) == 0xA
+        elif address < 0x4000:
+            self.rom_bank = (value & 0x7F) or 1
+        elif address < 0x6000:
+            self.ram_bank = value & 3
+
+
+MAPPINGS = {
+    0x00: MBC,
+    0x01: MBC1,
+    0x02: MBC1,
+    0x03: MBC1,
+    0x05: MBC2,
+    0x06: MBC2,
+    0x08: MBC,
+    0x09: MBC,
+    0x0F: MBC3,
+    0x10: MBC3,
+    0x11: MBC3,
+    0x12: MBC3,
+    0x13: MBC3,
+    0x19: MBC5,
+    0x1A: MBC5,
+    0x1B: MBC5,
+    0x1C: MBC5,
+    0x1D: MBC5,
+    0x1E: MBC5,
+    0x20: MBC6,
+    0x22: MBC7,
+    0xFC: GBCamera,
+    0xFD: TAMA5,
+    0xFE: HuC1,
+    0xFF: HuC1
+}
+
+
+def load(rom, ram=None):
+    return MAPPINGS.get(rom[0x147], Cartridge)(rom, ram)
+
+
+class LinkSim(object):
+    # Nothing to pace, so LinkDL may coalesce commands
+    PACED = True
+    IDLE = 0
+    SYNC = 1
+    COMMAND = 2
+
+    def __init__(self, cart, handshake=HANDSHAKE_LINK2, latency=0, bitrate=None, realtime=False,
+                 error_rate=0, seed=0):
+        self.cart = cart
+        self.handshake = handshake
+        self.latency = latency
+        self.bitrate = bitrate
+        self.realtime = realtime
+        # Chance of any streamed byte arriving with a flipped bit
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.state = self.IDLE
+        self.command = None
+        self.stream = None
+        self.stream_pos = 0
+        self.busy = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.exchanges = 0
+        self.transfers = 0
+        self.link_time = 0
+
+    def _transfer(self, n):
+        # Account for the time the transfer would take on a real cable
+        self.transfers += 1
+        t = self.latency
+        if self.bitrate:
+            t += n * 8.0 / self.bitrate
+        self.link_time += t
+        if self.realtime and t:
+            time.sleep(t)
+
+    def _corrupt(self, data):
+        data = bytearray(data)
+        for i in range(len(data)):
+            if self.random.random() < self.error_rate:
+                data[i] ^= 1 << self.random.randrange(8)
+        return data
+
+    def _start_stream(self, data):
+        if data:
+            self.stream = data
+            self.stream_pos = 0
+
+    def _exchange(self, byte):
+        self.exchanges += 1
+        if self.stream is not None:
+            b = self.stream[self.stream_pos]
+            self.stream_pos += 1
+            if self.stream_pos == len(self.stream):
+                self.stream = None
+            if self.error_rate and self.random.random() < self.error_rate:
+                b ^= 1 << self.random.randrange(8)
+            return b
+
+        if self.state == self.IDLE:
+            if byte == self.handshake:
+                self.state = self.SYNC
+            return 0xB4
+
+        if self.state == self.SYNC:
+            if byte != self.handshake:
+                self.state = self.IDLE
+                return 0x1D
+            self.state = self.COMMAND
+            self.command = None
+            data = self.cart.header() + b'\x00\xFF'
+            if self.handshake == HANDSHAKE_DL:
+                data += self.cart.read_block(0, 0x4000)
+            self._start_stream(data)
+            return 0x1D
+
+        if self.command is not None:
+            self.command.append(byte)
+            self._run_command()
+            return byte
+        if byte in (0x49, 0x59):
+            self.command = [byte]
+        elif byte == 0x89:
+            self.busy = True
+        elif byte == 0x8A:
+            self.busy = False
+        elif byte == self.handshake:
+            self.state = self.SYNC
+            return 0xB4
+        return byte
+
+    def _run_command(self):
+        cmd = self.command
+        if cmd[0] == 0x59 and len(cmd) == 5:
+            self.command = None
+            self._start_stream(self.cart.read_block((cmd[1] << 8) | cmd[2], (cmd[3] << 8) | cmd[4]))
+        elif cmd[0] == 0x49 and len(cmd) == 4:
+            self.command = None
+            self.cart.write((cmd[1] << 8) | cmd[2], cmd[3])
+
+    def tx(self, byte):
+        self._transfer(1)
+        return self._exchange(byte)
+
+    def rx(self):
+        return self.tx(0)
+
+    def txb(self, block):
+        self._transfer(len(block))
+        return bytes([self._exchange(b) for b in block])
+
+    def rxb(self, n=1):
+        self._transfer(n)
+        if self.stream is not None and self.stream_pos + n <= len(self.stream):
+            data = self.stream[self.stream_pos:self.stream_pos + n]
+            self.stream_pos += n
+            self.exchanges += n
+            if self.stream_pos == len(self.stream):
+                self.stream = None
+            if self.error_rate:
+                data = self._corrupt(data)
+            return bytes(data)
+        return bytes([self._exchange(0) for i in range(n)])
+
+
+class BridgeSim(object):
+    # Stands in for arduino.ino on a pseudo-terminal so LinkSerial and
+    # LinkBridge can be pointed at self.port without the board. link is
+    # the Game Boy side, e.g. a LinkSim. In framed mode the board's serial
+    # receive buffer holds BUFFER bytes and anything sent while it is full
+    # is lost, counted in dropped; the host is assumed to always outrun
+    # the clocked bytes, so whatever it has written arrives at once.
+    BUFFER = 64
+
+    def __init__(self, link, framed=True):
+        import tty  # Unix only
+        self.link = link
+        self.framed = framed
+        self.buffer = bytearray()
+        self.dropped = 0
+        self.gap = 20
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _receive(self, n):
+        # Up to n bytes from the receive buffer, waiting for at least one
+        if not self.buffer:
+            select.select([self.master], [], [])
+        while select.select([self.master], [], [], 0)[0]:
+            chunk = os.read(self.master, 0x1000)
+            if not chunk:
+                raise EOFError
+            room = self.BUFFER - len(self.buffer)
+            self.buffer += chunk[:room]
+            self.dropped += max(0, len(chunk) - room)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def _receive_all(self, n):
+        data = b''
+        while len(data) < n:
+            data += self._receive(n - len(data))
+        return data
+
+    def _write(self, data):
+        while data:
+            data = data[os.write(self.master, data):]
+
+    def _run(self):
+        try:
+            while True:
+                if not self.framed:
+                    self._write(self.link.txb(os.read(self.master, 0x1000)))
+                    continue
+                cmd, hi, lo = self._receive_all(3)
+                n = (hi << 8) | lo
+                if cmd == ord('X'):
+                    while n:
+                        data = self._receive(n)
+                        self._write(self.link.txb(data))
+                        n -= len(data)
+                elif cmd == ord('Z'):
+                    self._write(self.link.rxb(n))
+                elif cmd == ord('D'):
+                    self.gap = n
+        except (OSError, EOFError):
+            pass
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
@@ -0,0 +1,90 @@
+import os
+import threading
+
+
+class Metrics(object):
+    # Hook for LinkDL.set_trace. Counts commands and their latency per
+    # type (handshake, read, write, write_stream, busy), retries, bytes
+    # moved, link transfers and time spent sleeping. A write_stream is one
+    # transfer carrying bytes / 4 coalesced writes. One instance can be
+    # shared by several links.
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+            self.transfers = {}
+            self.retries = {}
+            self.sleep_time = 0
+
+    def _observe(self, table, kind, seconds, nbytes):
+        entry = table.get(kind)
+        if entry is None:
+            entry = table[kind] = {'count': 0, 'bytes': 0, 'time': 0,
+                                   'buckets': [0] * (len(self.BUCKETS) + 1)}
+        entry['count'] += 1
+        entry['bytes'] += nbytes
+        entry['time'] += seconds
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.BUCKETS)
+        entry['buckets'][i] += 1
+
+    def command(self, kind, seconds, nbytes=0):
+        with self.lock:
+            self._observe(self.commands, kind, seconds, nbytes)
+
+    def transfer(self, kind, seconds, nbytes):
+        with self.lock:
+            self._observe(self.transfers, kind, seconds, nbytes)
+
+    def retry(self, kind, count=1):
+        if count:
+            with self.lock:
+                self.retries[kind] = self.retries.get(kind, 0) + count
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.sleep_time += seconds
+
+    def snapshot(self):
+        with self.lock:
+            copy = lambda table: {k: dict(v, buckets=list(v['buckets'])) for k, v in table.items()}
+            return {
+                'commands': copy(self.commands),
+                'transfers': copy(self.transfers),
+                'retries': dict(self.retries),
+                'sleep_time': self.sleep_time,
+                'bytes': sum(v['bytes'] for v in self.commands.values()),
+            }
+
+    def format(self, prefix='gblink'):
+        # Prometheus text format
+        snapshot = self.snapshot()
+        lines = []
+        for table in ('commands', 'transfers'):
+            for kind, entry in sorted(snapshot[table].items()):
+                label = '{type="%s"}' % kind
+                lines.append('%s_%s_total%s %d' % (prefix, table, label, entry['count']))
+                lines.append('%s_%s_bytes_total%s %d' % (prefix, table, label, entry['bytes']))
+                total = 0
+                for bound, n in zip(self.BUCKETS + ('+Inf',), entry['buckets']):
+                    total += n
+                    lines.append('%s_%s_seconds_bucket{type="%s",le="%s"} %d' % (prefix, table, kind, bound, total))
+                lines.append('%s_%s_seconds_sum%s %f' % (prefix, table, label, entry['time']))
+                lines.append('%s_%s_seconds_count%s %d' % (prefix, table, label, total))
+        for kind, n in sorted(snapshot['retries'].items()):
+            lines.append('%s_retries_total{type="%s"} %d' % (prefix, kind, n))
+        lines.append('%s_sleep_seconds_total %f' % (prefix, snapshot['sleep_time']))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, prefix='gblink'):
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.format(prefix))
+        os.replace(path + '.tmp', path)
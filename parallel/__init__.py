@@ -19,47 +19,108 @@ class IParallel(object):
     ACK = 0x40
     BUSY = 0x80
 
-    def set_bit(self, pin, b):
+    shadow = False
+
+    def set_shadow(self, enable=True):
+        """Keep the last written data and control values in memory so that
+        set_bit does not need to read the registers back from the port.
+        Call resync if anything else may have touched the port."""
+        self.shadow = enable
+        if enable:
+            self.resync()
+
+    def resync(self):
+        self._shadow_data = self.get_data()
+        self._shadow_control = self.get_control()
+
+    def _get_data(self):
+        if self.shadow:
+            return self._shadow_data
+        return self.get_data()
+
+    def _set_data(self, reg):
+        if self.shadow:
+            self._shadow_data = reg
+        self.set_data(reg)
+
+    def _get_control(self):
+        if self.shadow:
+            return self._shadow_control
+        return self.get_control()
+
+    def _set_control(self, reg):
+        if self.shadow:
+            self._shadow_control = reg
+        self.set_control(reg)
+
+    def apply_bit(self, pin, b, data, control):
+        """Return the (data, control) register values that result from
+        setting pin to b, without touching the port."""
         if pin < 1:
             raise IndexError
         if pin == 1:
-            reg = self.get_control() & ~self.STROBE
+            control &= ~self.STROBE
             if not b:
-                reg |= self.STROBE
-            self.set_control(reg)
+                control |= self.STROBE
         elif pin <= 9:
-            pin -= 2
-            reg = self.get_data() & ~(1 << pin)
+            data &= ~(1 << (pin - 2))
             if b:
-                reg |= 1 << pin
-            self.set_data(reg)
+                data |= 1 << (pin - 2)
         elif pin == 14:
-            reg = self.get_control() & ~self.LINEFEED
+            control &= ~self.LINEFEED
             if not b:
-                reg |= self.LINEFEED
-            self.set_control(reg)
+                control |= self.LINEFEED
         elif pin == 16:
-            reg = self.get_control() & ~self.RESET
+            control &= ~self.RESET
             if b:
-                reg |= self.RESET
-            self.set_control(reg)
+                control |= self.RESET
         elif pin == 17:
-            reg = self.get_control() & ~self.SELECT_PRINTER
+            control &= ~self.SELECT_PRINTER
             if not b:
-                reg |= self.SELECT_PRINTER
-            self.set_control(reg)
+                control |= self.SELECT_PRINTER
         else:
             raise IndexError
+        return data, control
+
+    def pin_mask(self, pin):
+        """Return (is_control, mask): the register and the bits in it that
+        pin drives."""
+        data0, control0 = self.apply_bit(pin, 0, 0, 0)
+        data1, control1 = self.apply_bit(pin, 1, 0, 0)
+        if data0 != data1:
+            return False, data0 ^ data1
+        return True, control0 ^ control1
+
+    def set_bit(self, pin, b):
+        if 2 <= pin <= 9:
+            self._set_data(self.apply_bit(pin, b, self._get_data(), 0)[0])
+        else:
+            self._set_control(self.apply_bit(pin, b, 0, self._get_control())[1])
+
+    def play(self, wave, pin):
+        """Write a precomputed sequence of register changes to the port.
+        Each step is (is_control, mask, value), setting the bits in mask to
+        value and keeping the others, or None to sample pin. The sampled
+        bits are returned MSB first."""
+        bits = 0
+        for step in wave:
+            if step is None:
+                bits = (bits << 1) | self.get_bit(pin)
+            elif step[0]:
+                self._set_control(self._get_control() & ~step[1] | step[2])
+            else:
+                self._set_data(self._get_data() & ~step[1] | step[2])
+        return bits
 
     def get_bit(self, pin):
         if pin < 1:
             raise IndexError
         if pin == 1:
-            reg = self.get_control() & self.STROBE
+            reg = self._get_control() & self.STROBE
             return not reg
         if pin <= 9:
             pin -= 2
-            reg = self.get_data() & (1 << pin)
+            reg = self._get_data() & (1 << pin)
             return bool(reg)
         if pin == 10:
             reg = self.get_status() & self.ACK
@@ -74,16 +135,16 @@ class IParallel(object):
             reg = self.get_status() & self.SELECT
             return bool(reg)
         if pin == 14:
-            reg = self.get_control() & self.LINEFEED
+            reg = self._get_control() & self.LINEFEED
             return not reg
         if pin == 15:
             reg = self.get_status() & self.ERROR
             return bool(reg)
         if pin == 16:
-            reg = self.get_control() & self.RESET
+            reg = self._get_control() & self.RESET
             return bool(reg)
         if pin == 17:
-            reg = self.get_control() & self.SELECT_PRINTER
+            reg = self._get_control() & self.SELECT_PRINTER
             return not reg
         raise IndexError
 
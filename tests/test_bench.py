@@ -0,0 +1,20 @@
+import unittest
+
+from gb import bench
+
+
+class BenchTest(unittest.TestCase):
+    def test_every_case_runs(self):
+        results = bench.run(delay=0)
+        self.assertEqual([r['name'] for r in results['results']], [c.name for c in bench.CASES])
+        for r in results['results']:
+            self.assertNotIn('error', r, r['name'])
+            self.assertGreater(r['round_trips'], 0, r['name'])
+
+    def test_compare(self):
+        results = bench.run([bench.CASES[0].name], delay=0)
+        self.assertIn(bench.CASES[0].name, bench.compare(results, results))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import select
+import unittest
+
+from gb import LinkBridge, LinkSerial, conn, mbc, sim
+
+
+class PtyPort(object):
+    # Just enough of serial.Serial for LinkSerial and LinkBridge
+    def __init__(self, path, timeout=0.2):
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        self.timeout = timeout
+
+    def write(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def read(self, n):
+        data = b''
+        while len(data) < n and select.select([self.fd], [], [], self.timeout)[0]:
+            data += os.read(self.fd, n - len(data))
+        return data
+
+    def close(self):
+        os.close(self.fd)
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'needs a pseudo-terminal')
+class BridgeTest(unittest.TestCase):
+    def setUp(self):
+        self.cart = sim.load(sim.build_rom(0x1B, 1, 2), sim.random_bytes(0x2000, 1))
+
+    def open(self, cls, framed=True):
+        bridge = sim.BridgeSim(sim.LinkSim(self.cart), framed)
+        port = PtyPort(bridge.port)
+        self.addCleanup(bridge.close)
+        self.addCleanup(port.close)
+        dl = conn.detect_link(cls(port), conn.Pacer(0))
+        m = mbc.detect(dl)
+        m.unlock_ram()
+        return bridge, m
+
+    def round_trip(self, m):
+        self.assertEqual(m.dump_rom(), bytes(self.cart.rom))
+        ram = bytes(i & 0xFF for i in range(m.ramsize))
+        m.restore_ram(ram)
+        self.assertEqual(m.dump_ram(), ram)
+
+    def test_serial(self):
+        bridge, m = self.open(LinkSerial, framed=False)
+        self.round_trip(m)
+
+    def test_bridge(self):
+        bridge, m = self.open(LinkBridge)
+        self.round_trip(m)
+        self.assertEqual(bridge.dropped, 0)
+        self.assertEqual(bridge.gap, 400)
+
+    def test_long_frames_overrun_the_buffer(self):
+        class LongFrames(LinkBridge):
+            FRAME = 0x400
+        bridge, m = self.open(LongFrames)
+        try:
+            m.conn.write_batch([(0xA000 + i, i & 0xFF) for i in range(0x100)], verify=False)
+        except IOError:
+            pass
+        self.assertGreater(bridge.dropped, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from gb import sim
+from tests.util import connect
+
+
+class CameraTest(unittest.TestCase):
+    def setUp(self):
+        self.cart = sim.load(sim.build_rom(0xFC, 2, 4))
+        self.link, self.dl, self.m = connect(self.cart)
+
+    def test_camera_capture(self):
+        self.m.set_camera_defaults()
+        self.m.set_dither_matrix([[[0x40, 0x80, 0xC0]] * 4] * 4)
+        for timestamp, fps, frame in self.m.capture_stream(1):
+            pass
+        self.cart.frame -= 1
+        expected = [3 - sum(min(255, self.cart.sample(x, y)) >= t for t in (0x40, 0x80, 0xC0))
+                    for y in range(112) for x in range(128)]
+        self.assertEqual(list(frame), expected)
+
+    def test_adjust_exposure(self):
+        # Unknown exposure starts over from the default
+        self.assertEqual(self.m.adjust_exposure([0] * 16), self.m.EXPOSURE)
+        # A dark frame doubles it, an empty one leaves it alone
+        self.assertEqual(self.m.adjust_exposure([3] * 16), self.m.EXPOSURE * 2)
+        self.assertEqual(self.m.adjust_exposure([]), self.m.EXPOSURE * 2)
+        self.assertEqual(self.m.get_exposure(), self.m.EXPOSURE * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from gb import sim
+from gb.checkpoint import CheckpointStore
+from tests.util import connect
+
+
+class Interrupt(Exception):
+    pass
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_clear_keeps_other_files(self):
+        notes = os.path.join(self.path, 'notes.txt')
+        with open(notes, 'w') as f:
+            f.write('keep me')
+        cart = sim.load(sim.build_rom(0x1B, 2, 2))
+        link, dl, m = connect(cart)
+        store = CheckpointStore(self.path)
+        m.dump_rom(checkpoint=store)
+        store.clear()
+        self.assertEqual(os.listdir(self.path), ['notes.txt'])
+
+    def test_ram_is_not_served_after_a_dump(self):
+        cart = sim.load(sim.build_rom(0x1B, 2, 2), sim.random_bytes(0x2000, 1))
+        link, dl, m = connect(cart)
+        store = CheckpointStore(self.path)
+        m.dump_ram(checkpoint=store)
+        cart.ram[0] ^= 0xFF
+        self.assertEqual(m.dump_ram(checkpoint=store), bytes(cart.ram[:m.ramsize]))
+
+    def test_optimistic_dump_resumes_from_unverified_banks(self):
+        cart = sim.load(sim.build_rom(0x19, 2, 0))
+        link, dl, m = connect(cart)
+
+        def stop(i, data):
+            if i == 3:
+                raise Interrupt()
+        with self.assertRaises(Interrupt):
+            m.dump_rom(stop, optimistic=True, checkpoint=CheckpointStore(self.path))
+        store = CheckpointStore(self.path)
+        self.assertEqual(sorted(store.hashes), ['rom_unverified'])
+        self.assertEqual(len(store.hashes['rom_unverified']), 4)
+
+        # A bank that was read wrong before the interruption is repaired
+        bad = bytearray(store.get('rom_unverified', 2))
+        bad[0x100] ^= 0xFF
+        store.put('rom_unverified', 2, bytes(bad))
+        rom = m.dump_rom(optimistic=True, checkpoint=store)
+        self.assertEqual(rom, bytes(cart.rom))
+        self.assertEqual(sorted(store.hashes), ['rom'])
+        self.assertEqual(store.get('rom', 2), bytes(cart.rom[0x8000:0xC000]))
+
+
+if __name__ == '__main__':
+    unittest.main()
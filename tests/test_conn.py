@@ -0,0 +1,72 @@
+import unittest
+
+from gb import sim
+from tests.util import connect
+
+
+class EchoTest(unittest.TestCase):
+    def test_echo_mismatch_raises(self):
+        cart = sim.load(sim.build_rom(0x19, 2, 0))
+        link, dl, m = connect(cart)
+        link.txb = lambda block: bytes(len(block))
+        with self.assertRaises(IOError):
+            dl.write(0xA000, 0x55)
+
+    def test_echo_mismatch_raises_without_coalescing(self):
+        cart = sim.load(sim.build_rom(0x19, 2, 0))
+        link, dl, m = connect(cart)
+        dl.COALESCE = False
+        link.tx = lambda byte: 0
+        with self.assertRaises(IOError):
+            dl.write(0xA000, 0x55)
+        self.assertEqual(dl.echo_errors, dl.COMMAND_RETRIES + 1)
+
+    def test_command_returns_first_bad_offset(self):
+        cart = sim.load(sim.build_rom(0x19, 2, 0))
+        link, dl, m = connect(cart)
+        dl.COALESCE = False
+        tx = link.tx
+        link.tx = lambda byte: tx(byte) if byte != 0xA0 else 0
+        self.assertEqual(dl._command((0x49, 0xA0, 0x00, 0x55)), 1)
+
+
+class WriteBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.cart = sim.load(sim.build_rom(0x1B, 2, 2))
+        self.link, self.dl, self.m = connect(self.cart)
+        self.m.select_ram_bank(0)
+
+    def test_writes_that_did_not_stick_are_rewritten(self):
+        write = self.cart.write_ram
+        dropped = []
+
+        def flaky(offset, value):
+            if offset == 0x10 and not dropped:
+                dropped.append(value)
+                return
+            write(offset, value)
+        self.cart.write_ram = flaky
+        writes = [(0xA000 + i, i) for i in range(0x40)]
+        self.assertTrue(self.dl.write_batch(writes))
+        self.assertEqual(bytes(self.cart.ram[:0x40]), bytes(range(0x40)))
+        self.assertEqual(dropped, [0x10])
+
+    def test_stream_is_resent_from_the_first_bad_echo(self):
+        txb = self.link.txb
+        corrupted = []
+
+        def flaky(block):
+            echo = bytearray(txb(block))
+            if len(block) > 40 and not corrupted:
+                corrupted.append(block[40])
+                echo[40] ^= 0xFF
+            return bytes(echo)
+        self.link.txb = flaky
+        writes = [(0xA000 + i, 0xFF - i) for i in range(0x40)]
+        self.assertTrue(self.dl.write_batch(writes, verify=False))
+        self.assertEqual(bytes(self.cart.ram[:0x40]), bytes(0xFF - i for i in range(0x40)))
+        self.assertEqual(self.dl.echo_errors, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from gb import sim
+from tests.util import connect
+
+
+class OptimisticDumpTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_optimistic_dump_repairs_errors(self):
+        cart = sim.load(sim.build_rom(0x01, 5, 0))
+        link, dl, m = connect(cart, error_rate=0.00002, seed=1)
+        self.assertEqual(m.dump_rom(optimistic=True), bytes(cart.rom))
+
+    def test_dump_rom_to_file(self):
+        cart = sim.load(sim.build_rom(0x19, 3, 0))
+        link, dl, m = connect(cart, error_rate=0.00002, seed=2)
+        path = os.path.join(self.path, 'rom.gb')
+        m.dump_rom_to_file(path, optimistic=True)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), bytes(cart.rom))
+
+    def test_bad_global_checksum_raises(self):
+        rom = bytearray(sim.build_rom(0x19, 2, 0))
+        rom[0x5000] ^= 0xFF
+        cart = sim.load(rom)
+        link, dl, m = connect(cart)
+        with self.assertRaises(IOError):
+            m.dump_rom(optimistic=True)
+        with self.assertRaises(IOError):
+            m.dump_rom_to_file(os.path.join(self.path, 'rom.gb'), optimistic=True)
+        self.assertFalse(link.busy)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from gb import sim
+from tests.util import connect
+
+
+class FlashTest(unittest.TestCase):
+    def setUp(self):
+        self.cart = sim.load(sim.build_rom(0x20, 2, 3))
+        self.cart.flash[:0x4000] = sim.random_bytes(0x4000, 2)
+        # Past the end of the image but in the same sector
+        self.cart.flash[0x8000:0x8080] = sim.random_bytes(0x80, 3)
+        self.link, self.dl, self.m = connect(self.cart)
+
+    def test_program_without_erase(self):
+        flash = bytearray(self.cart.flash[:0x4000])
+        flash[5] &= 0x0F
+        flash[0x2100] &= 0xF0
+        stats = self.m.program_flash(bytes(flash))
+        self.assertEqual(bytes(self.cart.flash[:0x4000]), bytes(flash))
+        self.assertEqual((stats['erased'], stats['programmed'], stats['failed']), (0, 2, []))
+        self.assertEqual(stats['skipped'], stats['blocks'] - 2)
+        self.assertEqual(self.m.program_flash(bytes(flash))['skipped'], stats['blocks'])
+
+    def test_erase_reprograms_the_whole_sector(self):
+        before = bytes(self.cart.flash[0x4000:self.m.FLASH_SECTOR_SIZE])
+        flash = bytearray(self.cart.flash[:0x4000])
+        flash[5] &= 0x0F
+        flash[0x300] = 0xFF
+        stats = self.m.program_flash(bytes(flash))
+        self.assertEqual(bytes(self.cart.flash[:0x4000]), bytes(flash))
+        self.assertEqual(bytes(self.cart.flash[0x4000:self.m.FLASH_SECTOR_SIZE]), before)
+        # Every block of the image and the one past it, but no blank blocks
+        self.assertEqual((stats['erased'], stats['programmed'], stats['failed']),
+                         (1, 0x4000 // 0x80 + 1, []))
+        self.assertEqual(self.m.program_flash(bytes(flash))['skipped'], stats['blocks'])
+
+
+if __name__ == '__main__':
+    unittest.main()
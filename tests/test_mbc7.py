@@ -0,0 +1,32 @@
+import unittest
+
+from gb import sim
+from tests.util import connect, image
+
+
+class EepromTest(unittest.TestCase):
+    def setUp(self):
+        self.cart = sim.load(sim.build_rom(0x22, 2, 0))
+        self.link, self.dl, self.m = connect(self.cart)
+
+    def test_mbc7_eeprom(self):
+        for ram in (image(0x100), bytes([0x12, 0x34] * 0x80), b'\xff' * 0x100):
+            self.assertTrue(self.m.restore_ram(ram))
+            self.assertEqual(self.cart.dump_eeprom(), ram)
+            self.assertEqual(self.m.dump_ram(), ram)
+
+    def test_restore_only_writes_changed_words(self):
+        ram = bytearray(image(0x100))
+        self.m.restore_ram(bytes(ram))
+        ram[0x42] ^= 0xFF
+        ram[0x81] ^= 0xFF
+        writes = []
+        ram_write = self.m.ram_write
+        self.m.ram_write = lambda address, word: writes.append(address) or ram_write(address, word)
+        self.assertTrue(self.m.restore_ram(bytes(ram)))
+        self.assertEqual(writes, [0x21, 0x40])
+        self.assertEqual(self.cart.dump_eeprom(), bytes(ram))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from gb import conn, sim
+
+
+class PacerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'gblinkpy', 'pacing.json')
+
+    def test_load_without_a_file_uses_the_default(self):
+        pacer = conn.Pacer.load('/dev/ttyUSB0', 0.0003, self.path)
+        self.assertEqual(set(pacer.gaps.values()), {0.0003})
+
+    def test_save_and_load_by_port(self):
+        pacer = conn.Pacer.load('/dev/ttyUSB0', path=self.path)
+        pacer.failure('bulk')
+        pacer.save()
+        other = conn.Pacer.load('/dev/ttyUSB1', 0.0001, self.path)
+        other.save()
+        loaded = conn.Pacer.load('/dev/ttyUSB0', path=self.path)
+        self.assertEqual(loaded.gaps, pacer.gaps)
+        self.assertEqual(conn.Pacer.load('/dev/ttyUSB1', path=self.path).gaps, other.gaps)
+
+    def test_detect_link_loads_by_port(self):
+        pacer = conn.Pacer.load('sim', 0.0002, self.path)
+        pacer.save()
+        cart = sim.load(sim.build_rom(0x19, 1, 0))
+        with mock.patch.object(conn.Pacer, 'PATH', self.path):
+            dl = conn.detect_link(sim.LinkSim(cart), port='sim')
+        self.assertEqual((dl.pacer.port, dl.pacer.gaps['bulk']), ('sim', 0.0002))
+
+    def test_detect_link_probe_keeps_gap(self):
+        cart = sim.load(sim.build_rom(0x19, 1, 0))
+        pacer = conn.Pacer(0.0004)
+        for i in range(3):
+            dl = conn.detect_link(sim.LinkSim(cart, handshake=sim.HANDSHAKE_DL), pacer)
+            self.assertIsInstance(dl, conn.LinkDL)
+        self.assertEqual(pacer.gaps['handshake'], 0.0004)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+
+from parallel import IParallel
+from gb import LinkParallel
+
+
+class FakePort(IParallel):
+    # Counts register accesses, each of which is an ioctl on ppdev. SI
+    # (ACK) reads back SO (data bit 0), so a byte clocked out echoes.
+    def __init__(self):
+        self.data = 0
+        self.control = 0
+        self.calls = {'get_data': 0, 'set_data': 0, 'get_control': 0, 'set_control': 0, 'get_status': 0}
+
+    def get_data(self):
+        self.calls['get_data'] += 1
+        return self.data
+
+    def set_data(self, value):
+        self.calls['set_data'] += 1
+        self.data = value
+
+    def get_control(self):
+        self.calls['get_control'] += 1
+        return self.control
+
+    def set_control(self, value):
+        self.calls['set_control'] += 1
+        self.control = value
+
+    def get_status(self):
+        self.calls['get_status'] += 1
+        return self.ACK if self.data & 1 else 0
+
+    def reset(self):
+        for name in self.calls:
+            self.calls[name] = 0
+
+
+class ShadowTest(unittest.TestCase):
+    def test_set_bit_reads_back_without_shadow(self):
+        p = FakePort()
+        p.set_bit(1, 0)
+        p.set_bit(2, 1)
+        self.assertEqual(p.calls['get_control'], 1)
+        self.assertEqual(p.calls['get_data'], 1)
+
+    def test_set_bit_with_shadow_only_writes(self):
+        p = FakePort()
+        p.set_shadow()
+        p.reset()
+        for b in (0, 1, 0, 1):
+            p.set_bit(1, b)
+            p.set_bit(2, b)
+        self.assertEqual(p.calls['get_control'], 0)
+        self.assertEqual(p.calls['get_data'], 0)
+        self.assertEqual(p.calls['set_control'], 4)
+        self.assertEqual(p.calls['set_data'], 4)
+
+    def test_resync_picks_up_outside_writes(self):
+        p = FakePort()
+        p.set_shadow()
+        p.data = 0xF0
+        p.resync()
+        p.set_bit(2, 1)
+        self.assertEqual(p.data, 0xF1)
+
+
+class LinkParallelTest(unittest.TestCase):
+    def test_tx_echoes(self):
+        link = LinkParallel(FakePort(), shadow=True)
+        for byte in (0x00, 0x5A, 0xA5, 0xFF):
+            self.assertEqual(link.tx(byte), byte)
+
+    def test_syscalls_per_bit(self):
+        p = FakePort()
+        link = LinkParallel(p, shadow=True)
+        p.reset()
+        link.tx(0x55)
+        # Per bit: two clock edges, one status read and, as SO changes on
+        # every bit of 0x55, one data write; no register is read back
+        self.assertEqual(p.calls['set_control'], 16)
+        self.assertEqual(p.calls['get_status'], 8)
+        self.assertEqual(p.calls['set_data'], 8)
+        self.assertEqual(p.calls['get_data'] + p.calls['get_control'], 0)
+
+    def test_unchanged_so_is_not_rewritten(self):
+        p = FakePort()
+        link = LinkParallel(p, shadow=True)
+        p.reset()
+        link.tx(0x00)
+        self.assertEqual(p.calls['set_data'], 1)
+
+    def test_other_pins_are_kept_without_shadow(self):
+        p = FakePort()
+        link = LinkParallel(p)
+        p.data = 0xF0
+        p.control = 0x08
+        self.assertEqual(link.tx(0x5A), 0x5A)
+        self.assertEqual(p.data & 0xF0, 0xF0)
+        self.assertEqual(p.control & 0x08, 0x08)
+
+    def test_resync_keeps_outside_writes(self):
+        p = FakePort()
+        link = LinkParallel(p, shadow=True)
+        p.data = 0xF0
+        p.resync()
+        link.tx(0xFF)
+        self.assertEqual(p.data, 0xF1)
+
+
+if __name__ == '__main__':
+    unittest.main()
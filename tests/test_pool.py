@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from gb import conn, sim
+from gb.pool import CartPool
+
+
+class PoolTest(unittest.TestCase):
+    def setUp(self):
+        self.carts = {
+            'a': sim.load(sim.build_rom(0x1B, 1, 2), sim.random_bytes(0x2000, 1)),
+            'b': sim.load(sim.build_rom(0x19, 2, 0)),
+            'c': sim.load(sim.build_rom(0x22, 1, 0)),
+        }
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.pacing = os.path.join(self.path, 'pacing.json')
+        self.pool = CartPool({port: sim.LinkSim(cart) for port, cart in self.carts.items()},
+                             {'c': conn.Pacer(0)}, self.pacing)
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+    def test_jobs_run_on_each_port(self):
+        rom = self.pool.submit('b', 'dump_rom')
+        ram = self.pool.submit('a', 'dump_ram')
+        self.assertTrue(rom.wait(30) and ram.wait(30))
+        self.assertEqual(rom.result, bytes(self.carts['b'].rom))
+        self.assertEqual(ram.result, bytes(self.carts['a'].ram[:0x2000]))
+        snapshot = self.pool.snapshot()
+        self.assertEqual(snapshot['b']['done'], snapshot['b']['total'])
+        self.assertEqual((snapshot['a']['jobs'], snapshot['a']['failures']), (1, 0))
+
+    def test_pacers_are_loaded_and_saved_by_port(self):
+        with open(self.pacing, 'w') as f:
+            json.dump({'a': {'command': 0.001}}, f)
+        job = self.pool.submit('a', 'dump_ram')
+        self.assertTrue(job.wait(30))
+        self.assertEqual(self.pool.pacers['a'].port, 'a')
+        with open(self.pacing) as f:
+            saved = json.load(f)
+        self.assertEqual(sorted(saved), ['a'])
+        self.assertEqual(saved['a'], self.pool.pacers['a'].gaps)
+        # Pacers passed in aren't saved
+        self.assertTrue(self.pool.submit('c', 'dump_ram').wait(30))
+        with open(self.pacing) as f:
+            self.assertEqual(sorted(json.load(f)), ['a'])
+
+    def test_failed_restore_is_a_failure(self):
+        # An MBC7 EEPROM whose DO is stuck low never reports a write done
+        cart = self.carts['c']
+        read_ram = cart.read_ram
+        cart.read_ram = lambda offset: read_ram(offset) & ~1 if offset & 0xF0 == 0x80 else read_ram(offset)
+        job = self.pool.submit('c', 'restore_ram', data=b'\x12\x34' * 0x80)
+        self.assertTrue(job.wait(30))
+        self.assertIsNotNone(job.error)
+        snapshot = self.pool.snapshot()
+        self.assertEqual((snapshot['c']['state'], snapshot['c']['failures']), ('failed', 1))
+
+    def test_missing_cart_fails_only_its_port(self):
+        self.pool.links['a'] = sim.LinkSim(self.carts['a'], handshake=0)
+        failed = self.pool.submit('a', 'dump_ram')
+        ok = self.pool.submit('b', 'dump_rom')
+        self.assertTrue(failed.wait(30) and ok.wait(30))
+        self.assertIsNotNone(failed.error)
+        self.assertIsNone(ok.error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from gb import conn, mbc, record, sim
+
+
+class RecordTest(unittest.TestCase):
+    def setUp(self):
+        self.cart = sim.load(sim.build_rom(0x1B, 2, 2), sim.random_bytes(0x2000, 1))
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'session.gblr')
+
+    def test_record_and_replay(self):
+        with record.LinkRecorder(sim.LinkSim(self.cart), self.path) as rec:
+            m = mbc.detect(conn.detect_link(rec, conn.Pacer(0)))
+            m.unlock_ram()
+            rom, ram = m.dump_rom(), m.dump_ram()
+        replay = record.LinkReplay(self.path)
+        m = mbc.detect(conn.detect_link(replay, record.ReplayPacer()))
+        m.unlock_ram()
+        self.assertEqual((m.dump_rom(), m.dump_ram()), (rom, ram))
+        self.assertEqual(replay.remaining(), 0)
+
+    def test_diverging_replay_raises(self):
+        with record.LinkRecorder(sim.LinkSim(self.cart), self.path) as rec:
+            m = mbc.detect(conn.detect_link(rec, conn.Pacer(0)))
+            m.unlock_ram()
+            m.dump_ram()
+        replay = record.LinkReplay(self.path)
+        m = mbc.detect(conn.detect_link(replay, record.ReplayPacer()))
+        with self.assertRaises(ValueError):
+            m.conn.read(0x1234, 0x10)
+
+
+if __name__ == '__main__':
+    unittest.main()
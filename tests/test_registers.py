@@ -0,0 +1,30 @@
+import unittest
+
+from gb import sim
+from tests.util import connect
+
+
+class RegisterTest(unittest.TestCase):
+    def test_unchanged_registers_are_not_rewritten(self):
+        cart = sim.load(sim.build_rom(0x19, 3, 0))
+        link, dl, m = connect(cart)
+        m.select_rom_bank(3)
+        written = m.register_stats['written']
+        m.select_rom_bank(3)
+        m.select_rom_bank(4)
+        # Only the low byte of the bank number changed
+        self.assertEqual(m.register_stats['written'], written + 1)
+        self.assertEqual(m.read_rom_bank(4), bytes(cart.rom[0x10000:0x14000]))
+
+    def test_invalidate_writes_again(self):
+        cart = sim.load(sim.build_rom(0x19, 3, 0))
+        link, dl, m = connect(cart)
+        m.select_rom_bank(3)
+        cart.write(0x2000, 1)
+        m.invalidate()
+        m.select_rom_bank(3)
+        self.assertEqual(m.read_rom_bank(3), bytes(cart.rom[0xC000:0x10000]))
+
+
+if __name__ == '__main__':
+    unittest.main()
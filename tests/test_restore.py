@@ -0,0 +1,35 @@
+import unittest
+
+from gb import sim
+from tests.util import connect
+
+
+class RestoreDiffTest(unittest.TestCase):
+    def setUp(self):
+        self.cart = sim.load(sim.build_rom(0x1B, 2, 2), sim.random_bytes(0x2000, 1))
+        self.link, self.dl, self.m = connect(self.cart)
+
+    def test_restore_diff(self):
+        ram = bytearray(self.cart.ram[:self.m.ramsize])
+        ram[0x123] ^= 0xFF
+        self.m.restore_ram(bytes(ram), diff=True)
+        self.assertEqual(bytes(self.cart.ram[:self.m.ramsize]), bytes(ram))
+
+    def test_scattered_diffs_are_checked_with_one_read(self):
+        ram = bytearray(self.cart.ram[:self.m.ramsize])
+        for i in range(0, len(ram), 0x100):
+            ram[i] ^= 0xFF
+        self.m.select_ram_bank(0)
+        self.link.reset_stats()
+        self.m.restore_ram(bytes(ram), diff=True)
+        self.assertEqual(bytes(self.cart.ram[:self.m.ramsize]), bytes(ram))
+        changed = self.link.transfers
+        self.link.reset_stats()
+        self.m.restore_ram(bytes(ram), diff=True)
+        # One stream of writes and one more read_ec of the bank, which is
+        # two reads of each 2 KiB chunk, each a header and the data
+        self.assertEqual(changed - self.link.transfers, 1 + 2 * 2 * 0x2000 // 0x800)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from gb import conn, sim
+from tests.util import connect
+
+
+class NoSleep(conn.Pacer):
+    def sleep(self, seconds):
+        pass
+
+
+class RtcTest(unittest.TestCase):
+    def setUp(self):
+        self.now = [1000.0]
+        self.cart = sim.MBC3(sim.build_rom(0x10, 2, 3), clock=lambda: self.now[0])
+        self.cart.set_rtc_register(3, 0x34)
+        self.cart.set_rtc_register(4, 1)
+        self.link, self.dl, self.m = connect(self.cart)
+
+    def test_mbc3_rtc(self):
+        self.now[0] += 3661
+        snapshot = self.m.rtc_snapshot()
+        self.assertEqual((snapshot['days'], snapshot['hours'], snapshot['minutes'], snapshot['seconds']),
+                         (0x134, 1, 1, 1))
+        self.assertFalse(snapshot['halted'])
+
+    def test_poll_reports_drift(self):
+        # The cart clock gains a second between polls that the host
+        # doesn't see pass
+        self.dl.pacer = NoSleep(0)
+        snapshots = []
+        for snapshot in self.m.poll_rtc(60, 2):
+            snapshots.append(snapshot)
+            self.now[0] += 1
+        self.assertEqual(snapshots[0]['drift'], 0)
+        self.assertAlmostEqual(snapshots[1]['drift'], 1, delta=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
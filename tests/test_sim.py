@@ -0,0 +1,33 @@
+import unittest
+
+from gb import sim
+from tests.util import connect, image
+
+
+class RomTest(unittest.TestCase):
+    def test_dump_rom(self):
+        for carttype, romsize in ((0x19, 2), (0x01, 5), (0x10, 3)):
+            cart = sim.load(sim.build_rom(carttype, romsize, 2))
+            link, dl, m = connect(cart)
+            self.assertEqual(m.dump_rom(), bytes(cart.rom))
+
+
+class RamTest(unittest.TestCase):
+    def test_restore_and_dump(self):
+        cart = sim.load(sim.build_rom(0x1B, 2, 3), sim.random_bytes(0x8000, 1))
+        link, dl, m = connect(cart)
+        ram = image(m.ramsize)
+        m.restore_ram(ram)
+        self.assertEqual(bytes(cart.ram[:m.ramsize]), ram)
+        self.assertEqual(m.dump_ram(), ram)
+
+    def test_mbc2(self):
+        cart = sim.load(sim.build_rom(0x06, 2, 0))
+        link, dl, m = connect(cart)
+        ram = bytes(b | 0xF0 for b in image(m.ramsize))
+        m.restore_ram(ram)
+        self.assertEqual(m.dump_ram(), ram)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from gb import sim
+from tests.util import connect, image
+
+
+class Tama5Test(unittest.TestCase):
+    def test_restore_and_dump(self):
+        cart = sim.load(sim.build_rom(0xFD, 2, 0))
+        link, dl, m = connect(cart, error_rate=0.001, seed=3)
+        ram = image(0x20, 5)
+        self.assertTrue(m.restore_ram(ram))
+        self.assertEqual(m.dump_ram(), ram)
+
+    def test_partial_read(self):
+        cart = sim.load(sim.build_rom(0xFD, 2, 0))
+        link, dl, m = connect(cart)
+        ram = image(0x20, 9)
+        self.assertTrue(m.restore_ram(ram))
+        data = m.read_ram([3, 0x1F])
+        self.assertEqual((data[3], data[0x1F]), (ram[3], ram[0x1F]))
+        self.assertEqual(data[4], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from gb import conn, mbc, sim, trace
+
+
+class SleepLog(conn.Pacer):
+    def __init__(self):
+        super(SleepLog, self).__init__(0)
+        self.slept = []
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_metrics_counts_match_histograms(self):
+        cart = sim.load(sim.build_rom(0x1B, 2, 2))
+        link = sim.LinkSim(cart)
+        dl = conn.Link2(link, conn.Pacer(0))
+        metrics = trace.Metrics()
+        dl.set_trace(metrics)
+        dl.connect()
+        m = mbc.detect(dl)
+        m.unlock_ram()
+        m.restore_ram(bytes(m.ramsize))
+        snapshot = metrics.snapshot()
+        for kind in ('handshake', 'write', 'write_stream', 'read', 'busy'):
+            entry = snapshot['commands'][kind]
+            self.assertEqual(entry['count'], sum(entry['buckets']))
+        self.assertEqual(snapshot['commands']['write_stream']['bytes'], m.ramsize * 4)
+
+    def test_fixed_sleeps_go_through_the_pacer(self):
+        cart = sim.MBC3(sim.build_rom(0x10, 2, 3))
+        pacer = SleepLog()
+        m = mbc.detect(conn.detect_link(sim.LinkSim(cart), pacer))
+        del pacer.slept[:]
+        list(m.poll_rtc(60, 3))
+        self.assertEqual(pacer.slept.count(60), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
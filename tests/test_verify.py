@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from gb import sim
+from tests.util import connect
+
+
+class VerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.cart = sim.load(sim.build_rom(0x1B, 2, 3), sim.random_bytes(0x8000, 1))
+
+    def test_strategies_correct_errors(self):
+        for strategy in ('pair', 'subblock', 'vote', 'later'):
+            link, dl, m = connect(self.cart, error_rate=0.0005, seed=4)
+            m.select_rom_bank(1)
+            data = dl.read_ec(0x4000, 0x4000, strategy=strategy)
+            self.assertEqual(data, bytes(self.cart.rom[0x4000:0x8000]), strategy)
+            verifier = dl.verifier(strategy)
+            if strategy != 'vote':
+                # A vote over three reads fixes single errors by itself
+                self.assertGreater(verifier.stats['retries'], 0, strategy)
+            self.assertEqual(verifier.stats['failures'], 0, strategy)
+
+    def test_later_dump_rom(self):
+        link, dl, m = connect(self.cart, error_rate=0.0001, seed=5)
+        dl.VERIFY = 'later'
+        self.assertEqual(m.dump_rom(), bytes(self.cart.rom))
+        verifier = dl.verifier()
+        self.assertGreater(verifier.stats['retries'], 0)
+        self.assertEqual(verifier.pending, [])
+        # Each bank is read once and checked once, in 2 KiB chunks
+        self.assertEqual(verifier.stats['reads'] - verifier.stats['retries'],
+                         2 * len(self.cart.rom) // 0x800)
+
+    def test_later_dump_ram(self):
+        link, dl, m = connect(self.cart, error_rate=0.00005, seed=6)
+        dl.VERIFY = 'later'
+        self.assertEqual(m.dump_ram(), bytes(self.cart.ram[:m.ramsize]))
+        self.assertEqual(dl.verifier().pending, [])
+
+    def test_later_dump_rom_to_file(self):
+        link, dl, m = connect(self.cart, error_rate=0.0001, seed=7)
+        dl.VERIFY = 'later'
+        path = os.path.join(tempfile.mkdtemp(), 'rom.gb')
+        try:
+            m.dump_rom_to_file(path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), bytes(self.cart.rom))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
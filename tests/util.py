@@ -0,0 +1,13 @@
+from gb import conn, mbc, sim
+
+
+def connect(cart, **kwargs):
+    link = sim.LinkSim(cart, **kwargs)
+    dl = conn.detect_link(link, conn.Pacer(0))
+    m = mbc.detect(dl)
+    m.unlock_ram()
+    return link, dl, m
+
+
+def image(size, seed=0):
+    return bytes((i * 7 + seed) & 0xFF for i in range(size))